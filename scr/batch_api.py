@@ -0,0 +1,115 @@
+import json
+import os
+import time
+
+# Endpoint of the Azure OpenAI Batch API used for every request line
+BATCH_ENDPOINT = "/v1/responses"
+
+# Batch statuses after which no more results will arrive
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def write_batch_file(path, requests):
+    """
+    Write batch request lines to a JSONL file.
+
+    Args:
+        path: Path of the batch input file
+        requests: Dictionary mapping custom_id to the request body
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, body in requests.items():
+            f.write(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": body,
+            }, ensure_ascii=False) + "\n")
+
+def submit_batch(client, path, completion_window="24h"):
+    """
+    Upload a batch input file and create the batch job.
+
+    Returns:
+        The created batch object
+    """
+    with open(path, "rb") as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=completion_window,
+    )
+
+def wait_for_batch(client, batch_id, poll_interval=60):
+    """
+    Poll a batch job until it reaches a terminal status.
+
+    Returns:
+        The final batch object
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = getattr(batch, "request_counts", None)
+        progress = f" ({counts.completed} completed, {counts.failed} failed of {counts.total})" if counts else ""
+        print(f"Batch {batch_id}: {batch.status}{progress}")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+def response_body_text(body):
+    """Return the output text of a Responses API body returned by the Batch API, or None."""
+    if not isinstance(body, dict):
+        return None
+    if body.get("output_text"):
+        return body["output_text"]
+    for item in body.get("output") or []:
+        for content_item in item.get("content") or []:
+            if content_item.get("text"):
+                return content_item["text"]
+    return None
+
+def download_batch_results(client, batch):
+    """
+    Download the output and error files of a finished batch.
+
+    Returns:
+        Dictionary mapping custom_id to (response text, error message); exactly one of the two is None
+    """
+    results = {}
+    for file_id in (getattr(batch, "output_file_id", None), getattr(batch, "error_file_id", None)):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            error = entry.get("error")
+            text = response_body_text(response.get("body"))
+            if error or response.get("status_code") != 200 or text is None:
+                message = (error or {}).get("message") or f"status {response.get('status_code')}"
+                results[entry["custom_id"]] = (None, message)
+            else:
+                results[entry["custom_id"]] = (text, None)
+    return results
+
+def batch_state_path(directory, batch_id):
+    """Return the path of the file recording which rows a batch job covers."""
+    return os.path.join(directory, f"batch_{batch_id}.json")
+
+def save_batch_state(directory, batch_id, requests):
+    """
+    Record the items of every request of a batch, so results can be applied when resuming by batch id.
+
+    Args:
+        directory: Directory holding the state file
+        batch_id: Identifier of the batch job
+        requests: Dictionary mapping custom_id to a list of (key, position, industry) items
+    """
+    with open(batch_state_path(directory, batch_id), "w", encoding="utf-8") as f:
+        json.dump({"batch_id": batch_id, "requests": requests}, f, ensure_ascii=False)
+
+def load_batch_state(directory, batch_id):
+    """Return the custom_id to items dictionary saved by save_batch_state."""
+    with open(batch_state_path(directory, batch_id), "r", encoding="utf-8") as f:
+        return {custom_id: [tuple(item) for item in items] for custom_id, items in json.load(f)["requests"].items()}
@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from openpyxl import Workbook
+
+from extract_data import PREDEFINED_COLUMNS
+from mock_azure_server import load_categories, start_mock_server
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+ENGLISH_TITLES = [
+    "Sales Executive", "Accountant", "Software Engineer", "HR Officer", "Marketing Manager",
+    "Customer Service Staff", "Warehouse Supervisor", "Data Analyst", "Electrical Engineer",
+    "Executive Secretary", "Procurement Officer", "Graphic Designer", "Project Coordinator",
+    "Nurse", "Barista", "Chef", "Business Development Manager", "Financial Analyst",
+    "Quality Control Inspector", "Teacher",
+]
+THAI_TITLES = [
+    "พนักงานขาย", "นักบัญชี", "วิศวกรไฟฟ้า", "เจ้าหน้าที่ฝ่ายบุคคล", "ผู้จัดการฝ่ายการตลาด",
+    "พนักงานบริการลูกค้า", "หัวหน้าคลังสินค้า", "โปรแกรมเมอร์", "พยาบาล", "เลขานุการ",
+    "เจ้าหน้าที่จัดซื้อ", "นักออกแบบกราฟิก", "ผู้ประสานงานโครงการ", "พ่อครัว", "ครู",
+]
+ENGLISH_LEVELS = ["", "Senior ", "Junior ", "Assistant ", "Head of ", "Lead "]
+THAI_PREFIXES = ["", "ผู้ช่วย", "หัวหน้า"]
+THAI_SUFFIXES = ["", " อาวุโส", " ฝึกหัด"]
+INDUSTRIES = [
+    "Retail", "Banking", "Manufacturing", "Hospitality", "Information Technology",
+    "Healthcare", "Logistics", "Education", "ค้าปลีก", "ธนาคาร", "การผลิต", "โรงแรม",
+]
+PROVINCES = ["Bangkok", "Chiang Mai", "Chonburi", "Phuket", "Khon Kaen", "กรุงเทพมหานคร", "เชียงใหม่"]
+
+def generate_positions(count, rng):
+    """
+    Generate distinct (position, industry) pairs mixing English and Thai titles.
+
+    Args:
+        count: Number of pairs
+        rng: random.Random instance
+
+    Returns:
+        List of (position, industry) tuples with distinct mapping keys
+    """
+    combinations = []
+    for title in ENGLISH_TITLES:
+        combinations += [f"{level}{title}" for level in ENGLISH_LEVELS]
+    for title in THAI_TITLES:
+        combinations += [f"{prefix}{title}{suffix}" for prefix in THAI_PREFIXES for suffix in THAI_SUFFIXES]
+    pairs = [(position, industry) for position in combinations for industry in INDUSTRIES]
+    rng.shuffle(pairs)
+    # Larger sets than the combinations allow get numbered team suffixes, e.g. "Sales Executive (Team 12)"
+    generated = list(pairs[:count])
+    for i in range(len(generated), count):
+        position, industry = pairs[i % len(pairs)]
+        generated.append((f"{position} (Team {i // len(pairs)})", industry))
+    return generated
+
+def spelling_variant(position, rng):
+    """Return a spelling of a position that normalizes to the same mapping key."""
+    variant = rng.choice([position, position.upper(), position.lower(), f"  {position} ", position.replace(" ", "  ")])
+    return variant if rng.random() < 0.5 else position
+
+def generate_rows(count, duplicate_ratio, rng):
+    """
+    Generate the (position, industry) of every row.
+
+    Args:
+        count: Number of rows
+        duplicate_ratio: Share of rows (0 to 1) repeating a position/industry pair of another row;
+            repeats are partly spelled differently (case, spacing) as in real exports
+        rng: random.Random instance
+
+    Returns:
+        List of (position, industry) tuples
+    """
+    unique_count = max(1, round(count * (1 - duplicate_ratio)))
+    unique = generate_positions(unique_count, rng)
+    rows = list(unique[:count])
+    while len(rows) < count:
+        position, industry = rng.choice(unique)
+        rows.append((spelling_variant(position, rng), industry))
+    rng.shuffle(rows)
+    return rows
+
+def write_workbook(path, rows, rng):
+    """Write a synthetic Data.xlsx with the predefined columns and one row per (position, industry)."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(PREDEFINED_COLUMNS)
+    columns = {name: index for index, name in enumerate(PREDEFINED_COLUMNS)}
+    for number, (position, industry) in enumerate(rows, 1):
+        values = [None] * len(PREDEFINED_COLUMNS)
+        values[columns["No"]] = number
+        values[columns["Id"]] = f"C{number:07d}"
+        values[columns["SalaryExpectation"]] = rng.randrange(15000, 150000, 500)
+        values[columns["CurrencyType"]] = "THB"
+        values[columns["Age"]] = rng.randint(21, 60)
+        values[columns["State / Province"]] = rng.choice(PROVINCES)
+        values[columns["Education Level"]] = rng.choice(["Bachelor", "Master", "ปริญญาตรี", "ปริญญาโท"])
+        values[columns["CompanyName"]] = f"Company {rng.randint(1, 500)}"
+        values[columns["Position"]] = position
+        values[columns["Industry"]] = industry
+        values[columns["MonthlySalary"]] = rng.randrange(15000, 150000, 500)
+        values[columns["Province"]] = rng.choice(PROVINCES)
+        sheet.append(values)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    workbook.save(path)
+
+def run_stage(name, command, workdir, env):
+    """
+    Run one pipeline script in a child process.
+
+    Returns:
+        Dictionary with the exit code, wall seconds and peak resident memory in MB
+        (None where the platform cannot report it)
+    """
+    log_path = workdir / "logs" / f"{name}.log"
+    log_path.parent.mkdir(exist_ok=True)
+    with open(log_path, "w", encoding="utf-8") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        peak_rss_mb = None
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        else:
+            process.wait()
+        seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        print(f"Stage {name} failed with exit code {process.returncode}, see {log_path}")
+    return {"exit_code": process.returncode, "seconds": seconds, "peak_rss_mb": peak_rss_mb}
+
+def read_run_report(path):
+    """Load a run report written by one of the scripts, or None if it is missing."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def run_benchmark(rows=1000, duplicate_ratio=0.8, seed=42, storage="files", latency=0.05, rate_limit=0.0,
+                  retry_after=0.5, concurrency=16, positions_per_call=1, use_local_classifier=True,
+                  consolidate_workers=1, streaming=False, workdir=None, categories_file=None):
+    """
+    Generate a synthetic workbook and run extraction, mapping and consolidation against the mock server.
+
+    Args:
+        rows: Number of rows in the workbook
+        duplicate_ratio: Share of rows repeating another row's position and industry
+        seed: Seed of the synthetic data and of the injected failures
+        storage: Record layout used by all three scripts
+        latency: Seconds added by the mock server to every API call
+        rate_limit: Fraction of API calls answered with HTTP 429
+        retry_after: Delay in seconds requested by the 429 responses
+        concurrency: Concurrent requests of the async mapping mode
+        positions_per_call: Distinct positions classified per API call
+        use_local_classifier: Let the local classifier answer close matches
+        consolidate_workers: Processes parsing row files during consolidation
+        streaming: Use the constant-memory consolidation
+        workdir: Directory for the generated data and outputs
+        categories_file: job-category.json to use (default: the repository's)
+
+    Returns:
+        Dictionary with the benchmark parameters and the results of every stage
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    categories_file = Path(categories_file or SCRIPT_DIR.parent / "job-category.json")
+    shutil.copyfile(categories_file, workdir / "job-category.json")
+
+    rng = random.Random(seed)
+    print(f"Generating {rows} rows ({duplicate_ratio:.0%} duplicates) in {workdir}")
+    write_workbook(workdir / "data" / "Data.xlsx", generate_rows(rows, duplicate_ratio, rng), rng)
+
+    server = start_mock_server(load_categories(categories_file), latency=latency, rate_limit=rate_limit,
+                               retry_after=retry_after, seed=seed)
+    env = dict(os.environ,
+               AZURE_OPENAI_ENDPOINT=f"http://127.0.0.1:{server.server_address[1]}/",
+               AZURE_OPENAI_API_KEY="benchmark",
+               AZURE_API_VERSION=os.getenv("AZURE_API_VERSION") or "2025-03-01-preview",
+               AZURE_OPENAI_DEPLOYMENT="benchmark",
+               AZURE_OPENAI_MODEL_NAME="benchmark")
+
+    python = sys.executable
+    map_command = [python, str(SCRIPT_DIR / "map_job_families.py"), "--output", "output", "--storage", storage,
+                   "--cache_path", str(Path(".cache") / "benchmark.sqlite"), "--async_mode",
+                   "--concurrency", str(concurrency), "--positions_per_call", str(positions_per_call)]
+    if not use_local_classifier:
+        map_command.append("--no_local")
+    consolidate_command = [python, str(SCRIPT_DIR / "consolidate_json_to_csv.py"), "-i", "output",
+                           "-o", str(Path("output") / "consolidated.csv"), "-s", storage,
+                           "-w", str(consolidate_workers)]
+    if streaming:
+        consolidate_command.append("--streaming")
+    stages = [
+        ("extract", [python, str(SCRIPT_DIR / "extract_data.py"), "--rows", "-1", "--output", "output",
+                     "--storage", storage]),
+        ("mapping", map_command),
+        ("consolidate", consolidate_command),
+    ]
+
+    results = {}
+    try:
+        for name, command in stages:
+            print(f"Running {name}...")
+            calls_before = dict(server.state.counts)
+            result = run_stage(name, command, workdir, env)
+            result["rows_per_sec"] = rows / result["seconds"] if result["seconds"] else None
+            report = read_run_report(workdir / "output" / f"run_report_{name}.json")
+            if report:
+                result["stages"] = {stage: timing["seconds"] for stage, timing in report["stages"].items()}
+                result["counters"] = report["counters"]
+                result.update(report["rates"])
+                if report["request_latency"]["count"]:
+                    result["request_latency"] = report["request_latency"]
+            http_calls = server.state.counts["responses"] - calls_before["responses"]
+            if http_calls:
+                # Every HTTP request to the mock, including the connection test and 429 responses
+                result["http_calls"] = http_calls
+                result["http_calls_per_row"] = http_calls / rows
+                result["rate_limited"] = server.state.counts["rate_limited"] - calls_before["rate_limited"]
+            results[name] = result
+            if result["exit_code"] != 0:
+                break
+    finally:
+        server.shutdown()
+
+    total = sum(result["seconds"] for result in results.values())
+    return {
+        "parameters": {
+            "rows": rows, "duplicate_ratio": duplicate_ratio, "seed": seed, "storage": storage,
+            "latency": latency, "rate_limit": rate_limit, "retry_after": retry_after,
+            "concurrency": concurrency, "positions_per_call": positions_per_call,
+            "local_classifier": use_local_classifier, "consolidate_workers": consolidate_workers,
+            "streaming": streaming,
+        },
+        "python": sys.version.split()[0],
+        "stages": results,
+        "total_seconds": total,
+        "rows_per_sec": rows / total if total else None,
+    }
+
+def format_results(results):
+    """Render the benchmark results as a plain text table."""
+    lines = [f"  {'stage':<14}{'seconds':>10}{'rows/s':>12}{'peak RSS MB':>14}{'API calls/row':>15}"]
+    for name, stage in results["stages"].items():
+        rss = f"{stage['peak_rss_mb']:.1f}" if stage.get("peak_rss_mb") is not None else "n/a"
+        calls = f"{stage['api_calls_per_row']:.3f}" if "api_calls_per_row" in stage else ""
+        lines.append(f"  {name:<14}{stage['seconds']:>10.2f}{stage['rows_per_sec']:>12.1f}{rss:>14}{calls:>15}")
+    lines.append(f"  {'total':<14}{results['total_seconds']:>10.2f}{results['rows_per_sec']:>12.1f}")
+    mapping = results["stages"].get("mapping", {})
+    if "request_latency" in mapping:
+        latency = mapping["request_latency"]
+        lines.append(f"  API latency: p50 {latency['p50'] * 1000:.0f}ms, p95 {latency['p95'] * 1000:.0f}ms, "
+                     f"{mapping.get('rate_limited', 0)} rate-limited responses")
+    return "\n".join(lines)
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compare the results with an earlier benchmark run.
+
+    Args:
+        results: Results of this run
+        baseline: Results of the reference run, from the same parameters
+        tolerance: Allowed relative regression, e.g. 0.2 for 20%
+
+    Returns:
+        List of regression messages; empty when nothing regressed
+    """
+    if baseline.get("parameters") != results["parameters"]:
+        print("Warning: the baseline was run with different parameters")
+    regressions = []
+    for name, stage in results["stages"].items():
+        reference = baseline.get("stages", {}).get(name)
+        if not reference:
+            continue
+        # Lower rows/s, and higher memory or API calls, are regressions
+        checks = [("rows_per_sec", -1), ("peak_rss_mb", 1), ("api_calls_per_row", 1)]
+        for metric, direction in checks:
+            old, new = reference.get(metric), stage.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * direction
+            if change > tolerance:
+                regressions.append(f"{name} {metric}: {old:.3f} -> {new:.3f} ({change:+.0%} worse)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the extraction, mapping and consolidation pipeline against a local mock Azure OpenAI server.")
+    parser.add_argument("--rows", type=int, default=1000, help="Number of rows in the synthetic workbook.")
+    parser.add_argument("--duplicate_ratio", type=float, default=0.8, help="Share of rows repeating another row's position and industry (0-1).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic data and injected failures.")
+    parser.add_argument("--storage", choices=["files", "jsonl", "parquet"], default="files", help="Record layout used by all three scripts.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every mock API call.")
+    parser.add_argument("--rate_limit", type=float, default=0.0, help="Fraction of mock API calls answered with HTTP 429.")
+    parser.add_argument("--retry_after", type=float, default=0.5, help="Delay in seconds requested by the 429 responses.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent requests of the async mapping mode.")
+    parser.add_argument("--positions_per_call", type=int, default=1, help="Distinct positions classified per API call.")
+    parser.add_argument("--no_local", action="store_true", help="Send every position to the API.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes parsing row files during consolidation.")
+    parser.add_argument("--streaming", action="store_true", help="Use the constant-memory consolidation.")
+    parser.add_argument("--workdir", type=str, default=None, help="Directory for generated data (default: a temporary directory that is removed afterwards).")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this path.")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of an earlier run to compare with; exits with status 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline.")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="job-mapping-benchmark-")
+    try:
+        results = run_benchmark(
+            rows=args.rows,
+            duplicate_ratio=args.duplicate_ratio,
+            seed=args.seed,
+            storage=args.storage,
+            latency=args.latency,
+            rate_limit=args.rate_limit,
+            retry_after=args.retry_after,
+            concurrency=args.concurrency,
+            positions_per_call=args.positions_per_call,
+            use_local_classifier=not args.no_local,
+            consolidate_workers=args.workers,
+            streaming=args.streaming,
+            workdir=workdir,
+        )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    failed = [name for name, stage in results["stages"].items() if stage["exit_code"] != 0]
+    if failed:
+        sys.exit(f"Failed stages: {', '.join(failed)}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
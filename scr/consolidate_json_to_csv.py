@@ -1,18 +1,119 @@
 import os
 import json
 import csv
-import re
 import argparse
-from collections import OrderedDict
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-def natural_sort_key(s):
+from instrumentation import RunMetrics
+from record_store import STORAGE_LAYOUTS, JsonFileStore, load_changes, natural_sort_key, open_store
+
+# Number of files parsed by one worker task
+PARSE_CHUNK_SIZE = 500
+
+# Progress is reported once per this many records instead of once per file
+PROGRESS_EVERY = 1000
+
+# Stage timings and counters of the current run
+metrics = RunMetrics("consolidate")
+
+def iter_input_records(store, max_files=None):
+    """
+    Yield (row_id, data) for the records to consolidate.
+    Files are listed in natural order; single-file stores keep their extraction order.
+    """
+    # Limit the number of files if specified
+    if store.layout == "files":
+        row_ids = store.row_ids()
+        return store.iter_records(row_ids[:max_files] if max_files is not None else row_ids)
+    
+    records = store.iter_records()
+    if max_files is not None:
+        records = islice(records, max_files)
+    return records
+
+def report_progress(count, total=None, final=False):
+    """Print aggregate progress every PROGRESS_EVERY records and once at the end."""
+    if final or count % PROGRESS_EVERY == 0:
+        print(f"Processed {count}" + (f"/{total}" if total is not None else "") + " records")
+
+def parse_row_files(input_dir, row_ids, headers_only=False):
+    """
+    Parse a chunk of row files in a worker process.
+    
+    Args:
+        input_dir (str): Directory containing the row files
+        row_ids (list): Identifiers of the files in this chunk, in output order
+        headers_only (bool): Only collect the headers, without sending records back
+    
+    Returns:
+        tuple: (headers in first-seen order, records, error messages)
+    """
+    ordered_headers = OrderedDict()
+    records, errors = [], []
+    for _, data in JsonFileStore(input_dir).iter_records(row_ids, on_error=errors.append):
+        add_headers(ordered_headers, data)
+        if not headers_only:
+            records.append(data)
+    return list(ordered_headers), records, errors
+
+def iter_parsed_chunks(store, max_files, workers, headers_only=False):
+    """
+    Parse the row files in ordered chunks on a process pool.
+    
+    Chunk results are yielded in input order. Only a few chunks are in flight at a time,
+    so memory stays bounded even when writing is slower than parsing.
+    
+    Yields:
+        tuple: (headers in first-seen order, records, number of files in the chunk)
     """
-    Sort strings that contain numbers in natural order.
-    For example, row_10.json comes after row_2.json, not after row_1.json.
+    row_ids = store.row_ids()
+    if max_files is not None:
+        row_ids = row_ids[:max_files]
+    chunks = [row_ids[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(row_ids), PARSE_CHUNK_SIZE)]
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        chunk_iter = iter(chunks)
+        for chunk in islice(chunk_iter, workers * 2):
+            pending.append((pool.submit(parse_row_files, store.directory, chunk, headers_only), len(chunk)))
+        
+        while pending:
+            future, size = pending.popleft()
+            headers, records, errors = future.result()
+            for chunk in islice(chunk_iter, 1):
+                pending.append((pool.submit(parse_row_files, store.directory, chunk, headers_only), len(chunk)))
+            for message in errors:
+                print(message)
+            yield headers, records, size
+
+def add_headers(ordered_headers, data):
+    """Add any keys of data that are not yet in ordered_headers, keeping first-seen order."""
+    for key in data.keys():
+        if key not in ordered_headers:
+            ordered_headers[key] = None
+
+def load_header_schema(schema_file):
     """
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+    Load a predefined list of CSV headers.
+    
+    Args:
+        schema_file (str): A JSON file containing a list of column names, or a CSV file
+            (e.g. a previous consolidated.csv) whose first line is the header
+    
+    Returns:
+        list: Column names in output order
+    """
+    if schema_file.endswith('.json'):
+        with open(schema_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    with open(schema_file, 'r', encoding='utf-8-sig', newline='') as f:
+        return next(csv.reader(f))
 
-def consolidate_json_to_csv(input_dir, output_file, max_files=None):
+def consolidate_json_to_csv(input_dir, output_file, max_files=None, storage="files", streaming=False, schema_file=None,
+                            workers=1, incremental=False):
     """
     Consolidate JSON files from input_dir into a single CSV file.
     
@@ -20,67 +121,249 @@ def consolidate_json_to_csv(input_dir, output_file, max_files=None):
         input_dir (str): Directory containing JSON files.
         output_file (str): Output CSV file path.
         max_files (int, optional): Maximum number of files to process. Defaults to None (all files).
+        storage (str): Record layout: "files" (row_x.json, in natural order), "jsonl" or "parquet" (in stored order).
+        streaming (bool): Write records as they are read instead of holding them all in memory.
+            Headers are discovered in a first pass over the input, unless schema_file is given.
+        schema_file (str, optional): Predefined header list used by the streaming mode instead of the first pass.
+        workers (int): Number of processes parsing row files in parallel ("files" layout only).
+            The output is identical to the serial path.
+        incremental (bool): Update an existing output_file, re-reading only the row files written since
+            it was consolidated, instead of parsing every row file. Falls back to a full consolidation
+            when that is not possible.
     """
-    # Get all JSON files
-    json_files = [f for f in os.listdir(input_dir) if f.endswith('.json') and f.startswith('row_')]
+    metrics.reset()
+    started = time.time()
+    store = open_store(input_dir, storage)
+    if workers > 1 and store.layout != "files":
+        print(f"--workers only applies to the files layout; parsing the {storage} store serially")
+        workers = 1
     
-    # Sort files naturally
-    json_files.sort(key=natural_sort_key)
+    if incremental:
+        changes = load_changes(input_dir)
+        if changes is None:
+            print("The last extraction was not incremental; consolidating every row")
+        elif store.layout != "files" or max_files is not None or not os.path.exists(output_file):
+            print("Incremental consolidation needs the files layout, all rows and an existing output file; consolidating every row")
+        elif consolidate_incremental(store, output_file):
+            mark_consolidated(output_file, started)
+            return
     
-    # Limit the number of files if specified
-    if max_files is not None:
-        json_files = json_files[:max_files]
-    
-    if not json_files:
-        print(f"No JSON files found in {input_dir}")
+    if streaming:
+        if consolidate_streaming(store, input_dir, output_file, max_files, schema_file, workers):
+            mark_consolidated(output_file, started)
         return
     
-    # First pass: Collect all unique keys while preserving order from first file
+    # Collect all unique keys while preserving order from the first record
     ordered_headers = OrderedDict()
     all_data = []
     
-    # Process first file to establish initial column order
-    with open(os.path.join(input_dir, json_files[0]), 'r', encoding='utf-8') as f:
-        first_data = json.load(f, object_pairs_hook=OrderedDict)
-        for key in first_data.keys():
-            ordered_headers[key] = None
-    
-    # Process all files
-    for file_name in json_files:
-        try:
-            with open(os.path.join(input_dir, file_name), 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                all_data.append(data)
-                
-                # Add any new keys that weren't in the first file
-                for key in data.keys():
+    with metrics.stage("read"):
+        if workers > 1:
+            # Chunks arrive in input order, so merging their first-seen headers keeps the serial order
+            parsed = 0
+            for headers, records, size in iter_parsed_chunks(store, max_files, workers):
+                all_data.extend(records)
+                for key in headers:
                     if key not in ordered_headers:
                         ordered_headers[key] = None
-                        
-            print(f"Processed {file_name}")
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from {file_name}, skipping...")
-        except Exception as e:
-            print(f"Error processing {file_name}: {str(e)}")
+                parsed += size
+                print(f"Parsed {parsed} files")
+        else:
+            for row_id, data in iter_input_records(store, max_files):
+                all_data.append(data)
+            
+                # Add any new keys that weren't in the first record
+                add_headers(ordered_headers, data)
+                report_progress(len(all_data))
+    
+    if not all_data:
+        print(f"No JSON files found in {input_dir}")
+        return
+    report_progress(len(all_data), final=True)
     
     # Get final list of headers in the preserved order
     headers = list(ordered_headers.keys())
     
     # Write to CSV with UTF-8 encoding
-    with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+    with metrics.stage("write"), open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=headers)
         writer.writeheader()
         writer.writerows(all_data)
+    metrics.count("rows", len(all_data))
+    mark_consolidated(output_file, started)
     
     print(f"Successfully consolidated {len(all_data)} JSON files into {output_file}")
     print(f"Used UTF-8 encoding with signature (BOM) to ensure Thai characters display correctly")
 
+def mark_consolidated(output_file, started):
+    """
+    Date the CSV back to when its consolidation started, so that the next incremental
+    consolidation also re-reads row files written while this one was running.
+    """
+    os.utime(output_file, (started, started))
+
+def consolidate_streaming(store, input_dir, output_file, max_files=None, schema_file=None, workers=1):
+    """
+    Two-pass, constant-memory consolidation.
+    
+    Memory is constant for the files layout. The jsonl and parquet layouts merge their
+    mappings files into the records, which holds the latest mapping of every row in memory.
+    
+    The first pass only discovers the headers (first record order, then newly seen keys);
+    the second pass streams every record straight to the CSV writer. When schema_file
+    is given the first pass is skipped and keys outside the schema are dropped.
+    
+    Returns:
+        bool: Whether the CSV was written
+    """
+    with metrics.stage("header_pass"):
+        if schema_file:
+            headers = load_header_schema(schema_file)
+            print(f"Using {len(headers)} headers from {schema_file}")
+        elif workers > 1:
+            ordered_headers = OrderedDict()
+            for chunk_headers, _, _ in iter_parsed_chunks(store, max_files, workers, headers_only=True):
+                for key in chunk_headers:
+                    if key not in ordered_headers:
+                        ordered_headers[key] = None
+            headers = list(ordered_headers.keys())
+            print(f"Discovered {len(headers)} headers")
+        else:
+            ordered_headers = OrderedDict()
+            for _, data in iter_input_records(store, max_files):
+                add_headers(ordered_headers, data)
+            headers = list(ordered_headers.keys())
+            print(f"Discovered {len(headers)} headers")
+    
+    if not headers:
+        print(f"No JSON files found in {input_dir}")
+        return False
+    
+    known_headers = set(headers)
+    count = 0
+    rows_with_unknown_keys = 0
+    
+    if workers > 1:
+        records = (data for _, chunk, _ in iter_parsed_chunks(store, max_files, workers) for data in chunk)
+    else:
+        records = (data for _, data in iter_input_records(store, max_files))
+    
+    # Write to CSV with UTF-8 encoding
+    with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=headers, extrasaction='ignore')
+        writer.writeheader()
+        for data in records:
+            if not known_headers.issuperset(data.keys()):
+                rows_with_unknown_keys += 1
+            with metrics.stage("write"):
+                writer.writerow(data)
+            count += 1
+            report_progress(count)
+    report_progress(count, final=True)
+    metrics.count("rows", count)
+    
+    if rows_with_unknown_keys:
+        print(f"Warning: {rows_with_unknown_keys} records had keys missing from the header schema; those values were dropped")
+    print(f"Successfully consolidated {count} JSON files into {output_file}")
+    print(f"Used UTF-8 encoding with signature (BOM) to ensure Thai characters display correctly")
+    return True
+
+def csv_row_id(row):
+    """Return the identifier of a consolidated CSV row the way extract_data derives it: "No", else "Id"."""
+    return row.get("No") or row.get("Id") or None
+
+def consolidate_incremental(store, output_file):
+    """
+    Rewrite an existing CSV, re-reading only the row files written since it was consolidated.
+    
+    A row file is newer than the CSV when any extraction since then added or modified the
+    row, or a mapping run wrote its result, so several extractions and mapping runs may
+    happen between two consolidations. Other rows are copied from the previous CSV and rows
+    without a row file are dropped. Both the CSV and the row files are in natural row order,
+    so the merge streams through the previous CSV once; columns first seen in changed rows
+    are appended to the header.
+    
+    Args:
+        store: The files layout store holding the row files
+        output_file (str): The previously consolidated CSV, replaced in place
+    
+    Returns:
+        bool: False if the previous CSV does not line up with the row files; nothing is written then
+    """
+    row_ids = store.row_ids()
+    consolidated_at = os.path.getmtime(output_file)
+    with metrics.stage("read"):
+        changed = [row_id for row_id in row_ids if os.path.getmtime(store.path(row_id)) >= consolidated_at]
+        changed_records = dict(store.iter_records(changed))
+    current = set(row_ids)
+    deleted = 0
+    
+    def unchanged_rows(reader):
+        nonlocal deleted
+        for row in reader:
+            row_id = csv_row_id(row)
+            if row_id not in current:
+                deleted += 1
+            elif row_id not in changed_records:
+                yield row
+    
+    temp_file = f"{output_file}.tmp"
+    count = 0
+    aligned = True
+    with metrics.stage("write"), \
+            open(output_file, 'r', encoding='utf-8-sig', newline='') as previous, \
+            open(temp_file, 'w', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(previous)
+        ordered_headers = OrderedDict((key, None) for key in reader.fieldnames or [])
+        for data in changed_records.values():
+            add_headers(ordered_headers, data)
+        writer = csv.DictWriter(f, fieldnames=list(ordered_headers))
+        writer.writeheader()
+        
+        previous_rows = unchanged_rows(reader)
+        for row_id in row_ids:
+            if row_id in changed_records:
+                writer.writerow(changed_records[row_id])
+            else:
+                row = next(previous_rows, None)
+                if row is None or csv_row_id(row) != row_id:
+                    aligned = False
+                    break
+                writer.writerow(row)
+            count += 1
+            report_progress(count)
+        if next(previous_rows, None) is not None:
+            aligned = False
+    
+    if not aligned:
+        os.remove(temp_file)
+        print(f"{output_file} does not match the row files; consolidating every row")
+        return False
+    
+    os.replace(temp_file, output_file)
+    metrics.count("rows", count)
+    metrics.count("rows_reparsed", len(changed_records))
+    print(f"Incrementally consolidated {count} rows into {output_file}: {len(changed_records)} re-read, "
+          f"{deleted} deleted, {count - len(changed_records)} copied from the previous CSV")
+    return True
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Consolidate JSON files into a single CSV file')
     parser.add_argument('-i', '--input', default='output', help='Input directory containing JSON files (default: output)')
     parser.add_argument('-o', '--output', default='output/consolidated.csv', help='Output CSV file path (default: output/consolidated.csv)')
     parser.add_argument('-m', '--max', type=int, help='Maximum number of files to process')
+    parser.add_argument('-s', '--storage', choices=STORAGE_LAYOUTS, default='files', help='Record layout of the input directory (default: files)')
+    parser.add_argument('--streaming', action='store_true', help='Stream records to the CSV in two passes with constant memory (files layout; the other layouts keep one mapping per row in memory)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes parsing row files in parallel (default: 1)')
+    parser.add_argument('--schema', help='JSON list or CSV header file with the columns to write; skips the header discovery pass (implies --streaming)')
+    parser.add_argument('--incremental', action='store_true', help='Only re-read rows changed by the last incremental extraction and update the existing CSV')
+    parser.add_argument('--report', help='Path of the JSON run report (default: run_report_consolidate.json next to the CSV)')
+    parser.add_argument('--prometheus', help='Also write the run metrics in Prometheus text format to this path')
     
     args = parser.parse_args()
     
-    consolidate_json_to_csv(args.input, args.output, args.max) 
\ No newline at end of file
+    consolidate_json_to_csv(args.input, args.output, args.max, args.storage,
+                            streaming=args.streaming or bool(args.schema), schema_file=args.schema,
+                            workers=args.workers, incremental=args.incremental)
+    metrics.write_report(args.report or os.path.join(os.path.dirname(args.output), 'run_report_consolidate.json'),
+                         args.prometheus)
@@ -0,0 +1,160 @@
+import os
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from lexical_classifier import char_ngrams
+from normalization import normalize_text
+
+# Dimension of the local hashed n-gram embeddings
+HASHING_DIMENSIONS = 1024
+
+# Number of texts sent in one embeddings request
+EMBEDDING_BATCH_SIZE = 256
+
+class HashingEmbedder:
+    """
+    Deterministic local embedding backend for offline runs and tests.
+
+    Every character n-gram of the normalized text is hashed into one of a fixed
+    number of dimensions with a hash-derived sign, and the vector is L2 normalized,
+    so cosine similarity approximates n-gram overlap without any model or network.
+    """
+
+    def __init__(self, dimensions=HASHING_DIMENSIONS):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def embed(self, texts):
+        """
+        Embed texts.
+
+        Returns:
+            float32 array of shape (len(texts), dimensions) with unit-length rows
+        """
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram, count in Counter(char_ngrams(normalize_text(text))).items():
+                hashed = zlib.crc32(gram.encode("utf-8"))
+                vectors[row, hashed % self.dimensions] += count if hashed & 0x80000000 else -count
+        return normalize_rows(vectors)
+
+class AzureEmbedder:
+    """Embedding backend calling an Azure OpenAI embeddings deployment in batches."""
+
+    def __init__(self, client, deployment, batch_size=EMBEDDING_BATCH_SIZE):
+        """
+        Args:
+            client: AzureOpenAI client instance
+            deployment: Name of the embeddings deployment
+            batch_size: Number of texts per request
+        """
+        self.client = client
+        self.deployment = deployment
+        self.batch_size = batch_size
+        self.name = f"azure-{deployment}"
+        self.requests = 0
+
+    def embed(self, texts):
+        """
+        Embed texts, batch_size texts per request.
+
+        Returns:
+            float32 array of shape (len(texts), dimensions) with unit-length rows
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [text or " " for text in texts[start:start + self.batch_size]]
+            response = self.client.embeddings.create(model=self.deployment, input=batch)
+            self.requests += 1
+            vectors += [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        return normalize_rows(np.array(vectors, dtype=np.float32))
+
+def normalize_rows(matrix):
+    """Scale every row of a matrix to unit length; all-zero rows are left as they are."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+class SubFamilyIndex:
+    """
+    Embedding matrix of every (family, sub-family) pair, used to preselect the most
+    plausible sub-families of a position so the prompt only lists those.
+
+    The matrix is computed once per taxonomy and embedding backend and kept on disk.
+    """
+
+    def __init__(self, job_categories, embedder, taxonomy_hash, cache_dir=".cache"):
+        """
+        Load the sub-family matrix from the cache, or embed the taxonomy and save it.
+
+        Args:
+            job_categories: Dictionary of job families and their sub-families
+            embedder: HashingEmbedder or AzureEmbedder
+            taxonomy_hash: Hash of job_categories, part of the cache file name
+            cache_dir: Directory of the cached matrices
+        """
+        self.embedder = embedder
+        self.labels = [(family, sub_family) for family, sub_families in job_categories.items() for sub_family in sub_families]
+        self.path = os.path.join(cache_dir, f"subfamily_embeddings_{embedder.name}_{taxonomy_hash[:16]}.npy")
+
+        self.matrix = None
+        if os.path.exists(self.path):
+            matrix = np.load(self.path)
+            if matrix.shape[0] == len(self.labels):
+                self.matrix = matrix
+        if self.matrix is None:
+            print(f"Embedding {len(self.labels)} sub-families with {embedder.name}")
+            self.matrix = embedder.embed([sub_family for _, sub_family in self.labels])
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(self.path, self.matrix)
+
+    def _top_indices(self, positions, k):
+        """Return the similarity matrix and the indices of the k best sub-families per position, best first."""
+        k = min(k, len(self.labels))
+        scores = self.embedder.embed(positions) @ self.matrix.T
+        # argpartition finds the top k in linear time; only those k are sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+        return scores, np.take_along_axis(top, order, axis=1)
+
+    def top_k(self, positions, k=20):
+        """
+        Find the k sub-families most similar to each position.
+
+        Args:
+            positions: List of job position titles
+            k: Number of candidates per position
+
+        Returns:
+            List with, per position, a list of (family, sub_family, score) tuples, best first
+        """
+        if not positions:
+            return []
+        scores, top = self._top_indices(positions, k)
+        return [
+            [(*self.labels[index], float(scores[row, index])) for index in indices]
+            for row, indices in enumerate(top)
+        ]
+
+    def candidates(self, positions, k=20):
+        """
+        Restrict the taxonomy to the top-k sub-families of each position.
+
+        Returns:
+            List with, per position, a dictionary of job families and their candidate
+            sub-families, in taxonomy order
+        """
+        if not positions:
+            return []
+        _, top = self._top_indices(positions, k)
+        restricted = []
+        for indices in top:
+            categories = {}
+            # Labels are stored in taxonomy order, so sorted indices keep that order
+            for index in sorted(indices):
+                family, sub_family = self.labels[index]
+                categories.setdefault(family, []).append(sub_family)
+            restricted.append(categories)
+        return restricted
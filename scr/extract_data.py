@@ -1,109 +1,298 @@
 import pandas as pd
-import json
 import os
+import hashlib
+import json
 import argparse
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime, time
+from itertools import islice
+
+from openpyxl import load_workbook
+
+from instrumentation import RunMetrics
+from record_store import CHANGES_JSON, FINGERPRINTS_JSON, STORAGE_LAYOUTS, dump_json_atomic, open_store
+from run_manifest import RunManifest
+
+# Define the correct column headers
+PREDEFINED_COLUMNS = [
+    "No", "Id", "SalaryExpectation", "CurrencyType", "Age", 
+    "State / Province", "Education Level", "Major", "Degree", "Institute",
+    "Education From (Month/Year)", "Education To (Month/Year)", "FreshGraduate",
+    "Work From (Month/Year)", "Work To (Month/Year) / Present", "CompanyName", 
+    "Position", "Industry", "MonthlySalary", "Bonus", "CurrencyType2", 
+    "labelTh", "TestType", "Score", "Edu", "Column1", "Column2", 
+    "YOS-Y", "YOS-M", "YOS-Y หลังเรียนจบ", "YOS-M หลังเรียนจบ2", 
+    "Job Family", "Sub-Job Family", "YOS-Y2", "YOS-Y หลังเรียนจบ2", 
+    "YOS-Y หลังเรียนจบ3", "Final จับกลุ่ม", "Final Sub Job Family", 
+    "Experience", "Age2", "Province", "Region", "30Focus"
+]
 
-def extract_data(num_rows=10, output_folder="output"):
+def resolve_column_names(column_count, predefined_columns=PREDEFINED_COLUMNS):
+    """
+    Decide the output key of every column once, from the number of columns in the sheet.
+    
+    Args:
+        column_count (int): Number of columns in the header row
+        predefined_columns (list): Column names assigned in order
+    
+    Returns:
+        list: One unique string key per column
+    """
+    # Assign the predefined column names, handling case where Excel has fewer columns
+    if column_count <= len(predefined_columns):
+        # Use only as many predefined column names as there are columns in the sheet
+        names = predefined_columns[:column_count]
+    else:
+        # If Excel has more columns than our predefined list, use predefined ones and keep extras as is
+        names = list(predefined_columns)
+        for i in range(len(predefined_columns), column_count):
+            names.append(f"Extra_Column_{i+1}")
+    
+    keys = []
+    for name in names:
+        # Ensure key is a string
+        str_key = str(name) if name is not None else "None"
+        
+        # Handle duplicate keys by appending a suffix
+        if str_key in keys:
+            str_key = f"{str_key}_2"
+        keys.append(str_key)
+    return keys
+
+# Number of rows cleaned together; the types in each column are inspected once per chunk
+CLEAN_CHUNK_SIZE = 5000
+
+# Cell types that clean_value converts to ISO strings
+DATETIME_TYPES = (datetime, date, time, pd.Timestamp)
+
+# Strings that pd.read_excel reads as missing values by default (its na_values)
+NA_STRINGS = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+])
+
+def clean_value(value):
+    """
+    Convert a cell value to a JSON-serializable Python value.
+    This handles empty cells, NaN, the missing-value strings of pandas and timestamps.
+    """
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    if isinstance(value, str) and value in NA_STRINGS:
+        return None
+    if isinstance(value, (datetime, date, time, pd.Timestamp)):
+        return value.isoformat()
+    return value
+
+def clean_rows(keys, rows):
+    """
+    Clean a chunk of rows column by column and return them as dictionaries.
+    
+    The types present in each column are collected in a single pass, so only the
+    columns that hold timestamps, NaN or missing-value strings such as "N/A" go
+    through clean_value; all other cells are copied into the records as they are.
+    
+    Args:
+        keys (list): Unique key of every column
+        rows (list): Tuples of cell values, each as long as keys
+    
+    Returns:
+        list: Cleaned row dictionaries
+    """
+    records = [dict(zip(keys, values)) for values in rows]
+    for key, column in zip(keys, zip(*rows)):
+        types = set(map(type, column))
+        has_dates = any(issubclass(value_type, DATETIME_TYPES) for value_type in types)
+        has_nan = float in types and any(value != value for value in column if type(value) is float)
+        has_na_strings = str in types and not NA_STRINGS.isdisjoint(column)
+        if has_dates or has_nan or has_na_strings:
+            for record, value in zip(records, column):
+                record[key] = clean_value(value)
+    return records
+
+def skip_trailing_blank_rows(rows):
+    """
+    Yield rows, holding back blank ones until data follows them.
+    This matches pandas, which keeps blank rows inside the sheet but trims those at the end.
+    """
+    blank_rows = 0
+    for values in rows:
+        if all(value is None for value in values):
+            blank_rows += 1
+            continue
+        for _ in range(blank_rows):
+            yield ()
+        blank_rows = 0
+        yield values
+
+def iter_excel_rows(excel_file, num_rows=-1, predefined_columns=PREDEFINED_COLUMNS):
+    """
+    Stream cleaned row dictionaries from the first sheet of an Excel file.
+    
+    The workbook is opened in read-only mode, so rows are parsed lazily and
+    memory use does not grow with the size of the sheet. Rows are cleaned in
+    chunks of CLEAN_CHUNK_SIZE, one column at a time. The first row is the
+    header; its width decides the column names, which are then replaced by
+    predefined_columns.
+    
+    Args:
+        excel_file (Path): Path to the Excel file
+        num_rows (int): Maximum number of rows to yield. If -1, yield all rows.
+        predefined_columns (list): Column names assigned in order
+    
+    Yields:
+        dict: Cleaned row data keyed by column name
+    """
+    workbook = load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        
+        keys = resolve_column_names(len(header), predefined_columns)
+        rows = skip_trailing_blank_rows(rows)
+        if num_rows != -1:
+            rows = islice(rows, num_rows)
+        
+        width = len(keys)
+        while True:
+            chunk = list(islice(rows, CLEAN_CHUNK_SIZE))
+            if not chunk:
+                break
+            # Short rows are padded, so every column of the chunk has one value per row
+            chunk = [tuple(values[:width]) + (None,) * (width - len(values)) for values in chunk]
+            yield from clean_rows(keys, chunk)
+    finally:
+        workbook.close()
+
+# Stage timings and counters of the current run
+metrics = RunMetrics("extract")
+
+def row_fingerprint(data):
+    """Return a short hash of the content of an extracted row."""
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+def load_fingerprints(output_folder):
+    """Load the row fingerprints saved by the previous extraction, or an empty dictionary."""
+    path = os.path.join(output_folder, FINGERPRINTS_JSON)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def extract_data(num_rows=10, output_folder="output", storage="files", incremental=False, compact_json=False):
     """
     Extract data from Excel file and convert each row to a JSON file
     
     Args:
         num_rows (int): Number of rows to extract. If -1, extract all rows.
         output_folder (str): Path to the output folder
+        storage (str): Record layout: "files" (one row_x.json per row), "jsonl" or "parquet"
+        incremental (bool): Only write rows that are new or changed since the last extraction
+            ("files" layout only). Rows that disappeared from the workbook are removed, and the
+            changed rows are listed in extract_changes.json for the mapping and consolidation steps.
+        compact_json (bool): Write row files without indentation
     """
-    # Define the correct column headers
-    predefined_columns = [
-        "No", "Id", "SalaryExpectation", "CurrencyType", "Age", 
-        "State / Province", "Education Level", "Major", "Degree", "Institute",
-        "Education From (Month/Year)", "Education To (Month/Year)", "FreshGraduate",
-        "Work From (Month/Year)", "Work To (Month/Year) / Present", "CompanyName", 
-        "Position", "Industry", "MonthlySalary", "Bonus", "CurrencyType2", 
-        "labelTh", "TestType", "Score", "Edu", "Column1", "Column2", 
-        "YOS-Y", "YOS-M", "YOS-Y หลังเรียนจบ", "YOS-M หลังเรียนจบ2", 
-        "Job Family", "Sub-Job Family", "YOS-Y2", "YOS-Y หลังเรียนจบ2", 
-        "YOS-Y หลังเรียนจบ3", "Final จับกลุ่ม", "Final Sub Job Family", 
-        "Experience", "Age2", "Province", "Region", "30Focus"
-    ]
-
     # Create output directory if it doesn't exist
     output_dir = Path(output_folder)
     output_dir.mkdir(exist_ok=True)
-
-    # Read the Excel file - don't skip any rows since we'll manually assign column names
-    excel_file = Path("data/Data.xlsx")
-    df = pd.read_excel(excel_file)
-    
-    # Assign the predefined column names, handling case where Excel has fewer columns
-    if len(df.columns) <= len(predefined_columns):
-        # Use only as many predefined column names as there are columns in the dataframe
-        df.columns = predefined_columns[:len(df.columns)]
-    else:
-        # If Excel has more columns than our predefined list, use predefined ones and keep extras as is
-        new_columns = predefined_columns.copy()
-        for i in range(len(predefined_columns), len(df.columns)):
-            new_columns.append(f"Extra_Column_{i+1}")
-        df.columns = new_columns
+    metrics.reset()
+    store = open_store(output_folder, storage, compact=compact_json)
+    if incremental and store.layout != "files":
+        print(f"Incremental extraction only applies to the files layout; extracting the {storage} store in full")
+        incremental = False
     
-    # Determine how many rows to process
-    total_rows = len(df)
-    if num_rows == -1:
-        row_limit = total_rows
-    else:
-        row_limit = min(num_rows, total_rows)
+    # Fingerprints are saved on every run so that the next run can be incremental
+    previous = load_fingerprints(output_folder) if incremental else {}
+    fingerprints = {}
+    changes = {"new": [], "modified": [], "deleted": []}
+    if not incremental:
+        store.reset()
 
-    print(f"Extracting {row_limit} rows from {excel_file}")
+    excel_file = Path("data/Data.xlsx")
+    print(f"Extracting {'all' if num_rows == -1 else f'up to {num_rows}'} rows from {excel_file}")
 
-    # Process each row and convert to JSON
-    for index in range(row_limit):
-        # Extract row data
-        row_data = df.iloc[index].to_dict()
-        
-        # Convert any pandas data types to Python native types
-        # This handles NaN, timestamps, and other pandas-specific types
-        clean_data = {}
-        for key, value in row_data.items():
-            # Ensure key is a string
-            str_key = str(key) if key is not None else "None"
+    # Rows are streamed one at a time, so only the requested rows are ever parsed
+    # The extract stage covers reading the workbook and writing; reading alone is extract minus write
+    row_count = 0
+    with metrics.stage("extract"):
+        for index, clean_data in enumerate(iter_excel_rows(excel_file, num_rows)):
+            # Use "No" column as primary unique key if it exists, 
+            # fall back to "Id" if "No" doesn't exist, 
+            # and finally use index+1 if neither exists
+            no_value = clean_data.get('No')
+            if no_value is not None:
+                identifier = no_value
+            else:
+                identifier = clean_data.get('Id', index + 1)
             
-            # Handle duplicate keys by appending a suffix
-            if str_key in clean_data:
-                str_key = f"{str_key}_2"
-                
-            if pd.isna(value):
-                clean_data[str_key] = None
-            elif isinstance(value, (datetime, pd.Timestamp)):
-                clean_data[str_key] = value.isoformat()
+            row_id = str(identifier)
+            fingerprint = row_fingerprint(clean_data)
+            fingerprints[row_id] = fingerprint
+            old_fingerprint = previous.get(row_id)
+            
+            if incremental and old_fingerprint == fingerprint and os.path.exists(store.path(row_id)):
+                # Unchanged rows keep their file, including any mapping already written into it
+                metrics.count("rows_unchanged")
             else:
-                clean_data[str_key] = value
-        
-        # Use "No" column as primary unique key if it exists, 
-        # fall back to "Id" if "No" doesn't exist, 
-        # and finally use index+1 if neither exists
-        no_value = clean_data.get('No')
-        if no_value is not None:
-            identifier = no_value
-        else:
-            identifier = clean_data.get('Id', index + 1)
+                if incremental:
+                    changes["new" if old_fingerprint is None else "modified"].append(row_id)
+                # Save as row_{identifier}.json, or append to the single-file store
+                with metrics.stage("write"):
+                    store.write_record(identifier, clean_data)
             
-        json_filename = f"row_{identifier}.json"
-        output_path = output_dir / json_filename
-        
-        # Save as JSON file
-        with open(output_path, 'w', encoding='utf-8') as json_file:
-            json.dump(clean_data, json_file, indent=2, ensure_ascii=False)
-        
-        # Print progress every 100 rows when processing large datasets
-        if (index + 1) % 100 == 0 or index == 0 or index == row_limit - 1:
-            print(f"Processed {index + 1} of {row_limit} rows")
+            row_count = index + 1
+            # Print progress every 100 rows when processing large datasets
+            if row_count % 100 == 0 or index == 0:
+                print(f"Processed {row_count} rows")
+
+        if incremental:
+            if num_rows == -1:
+                # Only a complete read of the workbook can tell which rows were deleted
+                changes["deleted"] = [row_id for row_id in previous if row_id not in fingerprints]
+                for row_id in changes["deleted"]:
+                    store.delete(row_id)
+            else:
+                fingerprints = {**previous, **fingerprints}
+            
+            # Mapping results journaled for changed or deleted rows are no longer valid
+            stale = changes["modified"] + changes["deleted"]
+        else:
+            # Every written record starts without a mapping, whatever the journals say
+            stale = list(fingerprints)
+        if stale:
+            manifest = RunManifest(output_folder, shard_name="extract")
+            manifest.record_many((row_id, None, None) for row_id in stale)
+            manifest.close()
 
-    print(f"Successfully created {row_limit} JSON files in the '{output_folder}' directory.")
+        with metrics.stage("write"):
+            store.close()
+            dump_json_atomic(os.path.join(output_folder, FINGERPRINTS_JSON), fingerprints, indent=None)
+            dump_json_atomic(os.path.join(output_folder, CHANGES_JSON), changes if incremental else {"full": True}, indent=None)
+    metrics.count("rows", row_count)
+    if incremental:
+        for kind in ("new", "modified", "deleted"):
+            metrics.count(f"rows_{kind}", len(changes[kind]))
+        print(f"Incremental extraction: {len(changes['new'])} new, {len(changes['modified'])} modified, "
+              f"{len(changes['deleted'])} deleted and {row_count - len(changes['new']) - len(changes['modified'])} "
+              f"unchanged rows (listed in {os.path.join(output_folder, CHANGES_JSON)})")
+    elif storage == "files":
+        print(f"Successfully created {row_count} JSON files in the '{output_folder}' directory.")
+    else:
+        print(f"Successfully wrote {row_count} records to the {storage} store in the '{output_folder}' directory.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract data from Excel and convert to JSON files")
     parser.add_argument("--rows", type=int, default=20, help="Number of rows to extract. Use -1 for all rows.")
     parser.add_argument("--output", type=str, default="output", help="Output directory path")
+    parser.add_argument("--storage", choices=STORAGE_LAYOUTS, default="files", help="Record layout: one row_x.json per row, a single JSONL file, or Parquet.")
+    parser.add_argument("--incremental", action="store_true", help="Only write rows that are new or changed since the last extraction (files layout).")
+    parser.add_argument("--compact_json", action="store_true", help="Write row files without indentation.")
+    parser.add_argument("--report", type=str, default=None, help="Path of the JSON run report (default: <output>/run_report_extract.json).")
+    parser.add_argument("--prometheus", type=str, default=None, help="Also write the run metrics in Prometheus text format to this path.")
     args = parser.parse_args()
     
-    extract_data(args.rows, args.output) 
\ No newline at end of file
+    extract_data(args.rows, args.output, args.storage, args.incremental, args.compact_json)
+    metrics.write_report(args.report or os.path.join(args.output, "run_report_extract.json"), args.prometheus) 
@@ -0,0 +1,216 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Quantiles reported for the API request latency
+LATENCY_QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+def percentile(sorted_values, q):
+    """Return the nearest-rank q-quantile (0 to 1) of an ascending list, or None if it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(q * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+def write_text(path, content):
+    """Write a report file, creating its directory if needed."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    print(f"Wrote {path}")
+
+class RunMetrics:
+    """
+    Timings and counters of one script run.
+
+    Stage timings accumulate wall time and the number of timed sections per stage,
+    so a stage that runs once per row reports its total cost. API request latencies
+    are kept individually for percentiles. Concurrent requests overlap, so in async
+    mode the api_call total can exceed the wall time of the run. Recording is
+    thread-safe, so worker threads may share one instance.
+    """
+
+    def __init__(self, script, latency_window=None):
+        """
+        Args:
+            script: Name of the script, used in the report and as a metric label
+            latency_window: Number of most recent latencies the percentiles are computed
+                over, so a long-running service keeps bounded memory; None keeps all
+        """
+        self.script = script
+        self.latency_window = latency_window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far and restart the run clock."""
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.latencies = deque(maxlen=self.latency_window)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.counters = {}
+
+    def add_time(self, name, seconds, count=1):
+        """Add wall time to a stage."""
+        with self._lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + count)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as part of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def observe_request(self, seconds, stage="api_call"):
+        """Record the latency of one request, also adding it to a stage."""
+        with self._lock:
+            self.latencies.append(seconds)
+            self.latency_count += 1
+            self.latency_sum += seconds
+        self.add_time(stage, seconds)
+
+    def count(self, name, amount=1):
+        """Increase a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, report, latencies=()):
+        """
+        Add the stages, counters and request latencies of another run, e.g. a worker process.
+
+        Args:
+            report: Dictionary returned by the other run's report()
+            latencies: The other run's individual request latencies, for exact percentiles
+        """
+        with self._lock:
+            for name, stage in report["stages"].items():
+                total, calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (total + stage["seconds"], calls + stage["count"])
+            for name, value in report["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            latency = report["request_latency"]
+            self.latency_count += latency["count"]
+            self.latency_sum += latency.get("mean", 0) * latency["count"]
+            self.latencies.extend(latencies)
+
+    def report(self):
+        """
+        Summarize the run.
+
+        Returns:
+            Dictionary with the stage timings, request latency percentiles, counters
+            and derived rates; JSON serializable
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            latency = {"count": self.latency_count}
+            if self.latency_count:
+                latency["mean"] = self.latency_sum / self.latency_count
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        if latencies:
+            for q in LATENCY_QUANTILES:
+                latency[f"p{round(q * 100)}"] = percentile(latencies, q)
+            latency["max"] = latencies[-1]
+
+        rates = {}
+        lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+        if lookups:
+            rates["cache_hit_rate"] = counters.get("cache_hits", 0) / lookups
+        if counters.get("input_tokens"):
+            rates["cached_token_rate"] = counters.get("cached_tokens", 0) / counters["input_tokens"]
+        if counters.get("rows") and "requests" in counters:
+            rates["api_calls_per_row"] = counters.get("requests", 0) / counters["rows"]
+
+        return {
+            "script": self.script,
+            "started_at": self.started_at,
+            "wall_seconds": time.perf_counter() - self._start,
+            "stages": {name: {"seconds": total, "count": calls} for name, (total, calls) in stages.items()},
+            "request_latency": latency,
+            "counters": counters,
+            "rates": rates,
+        }
+
+    def format_table(self):
+        """Render the report as a plain text table."""
+        report = self.report()
+        lines = [f"Run report ({self.script}): {report['wall_seconds']:.2f}s wall time"]
+        if report["stages"]:
+            lines.append(f"  {'stage':<24}{'seconds':>12}{'count':>10}")
+            for name, stage in report["stages"].items():
+                lines.append(f"  {name:<24}{stage['seconds']:>12.3f}{stage['count']:>10}")
+        latency = report["request_latency"]
+        if latency["count"]:
+            quantiles = "  ".join(f"p{round(q * 100)} {latency[f'p{round(q * 100)}'] * 1000:.0f}ms" for q in LATENCY_QUANTILES)
+            lines.append(f"  API latency over {latency['count']} requests: mean {latency['mean'] * 1000:.0f}ms  {quantiles}  max {latency['max'] * 1000:.0f}ms")
+        for name, value in report["counters"].items():
+            lines.append(f"  {name:<24}{value:>12}")
+        for name, value in report["rates"].items():
+            lines.append(f"  {name:<24}{value:>12.3f}")
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix="job_mapping"):
+        """Render the report in the Prometheus text exposition format."""
+        report = self.report()
+        label = f'script="{self.script}"'
+        lines = [
+            f"# HELP {prefix}_run_seconds Wall time of the run.",
+            f"# TYPE {prefix}_run_seconds gauge",
+            f"{prefix}_run_seconds{{{label}}} {report['wall_seconds']}",
+            f"# HELP {prefix}_stage_seconds_total Wall time spent per stage.",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ]
+        for name, stage in report["stages"].items():
+            lines.append(f'{prefix}_stage_seconds_total{{{label},stage="{name}"}} {stage["seconds"]}')
+        lines += [
+            f"# HELP {prefix}_stage_calls_total Number of timed sections per stage.",
+            f"# TYPE {prefix}_stage_calls_total counter",
+        ]
+        for name, stage in report["stages"].items():
+            lines.append(f'{prefix}_stage_calls_total{{{label},stage="{name}"}} {stage["count"]}')
+
+        latency = report["request_latency"]
+        lines += [
+            f"# HELP {prefix}_request_latency_seconds Latency of API requests.",
+            f"# TYPE {prefix}_request_latency_seconds summary",
+        ]
+        for q in LATENCY_QUANTILES if latency["count"] else []:
+            lines.append(f'{prefix}_request_latency_seconds{{{label},quantile="{q}"}} {latency[f"p{round(q * 100)}"]}')
+        lines.append(f"{prefix}_request_latency_seconds_sum{{{label}}} {latency.get('mean', 0) * latency['count']}")
+        lines.append(f"{prefix}_request_latency_seconds_count{{{label}}} {latency['count']}")
+
+        for name, value in report["counters"].items():
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric}{{{label}}} {value}"]
+        for name, value in report["rates"].items():
+            metric = f"{prefix}_{name}"
+            lines += [f"# TYPE {metric} gauge", f"{metric}{{{label}}} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path, prometheus_path=None):
+        """
+        Print the table and write the JSON report, and optionally the Prometheus metrics.
+
+        Args:
+            path: Path of the JSON report, or None to skip it
+            prometheus_path: Path of the Prometheus text file, e.g. for the node exporter textfile collector
+        """
+        print(self.format_table())
+        if path:
+            write_text(path, json.dumps(self.report(), indent=2))
+        if prometheus_path:
+            write_text(prometheus_path, self.to_prometheus())
@@ -0,0 +1,111 @@
+import heapq
+import math
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+from normalization import normalize_text
+
+NGRAM_SIZE = 3
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Return the character n-grams of a normalized text, padded so word boundaries count."""
+    padded = f" {text} "
+    return [padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))]
+
+class LexicalClassifier:
+    """
+    In-process classifier that matches positions to sub-families without calling the API.
+
+    Every sub-family in job-category.json is indexed once as a TF-IDF vector of
+    character n-grams. Exact titles are answered from a dictionary and other
+    positions are scored with an inverted index lookup, both far cheaper than an
+    API call. Only confident, unambiguous matches are answered locally; everything
+    else is left for the LLM.
+    """
+
+    def __init__(self, job_categories):
+        """
+        Build the index.
+
+        Args:
+            job_categories: Dictionary of job families and their sub-families
+        """
+        # The same sub-family name can appear in several families, e.g. "Product Manager"
+        self.labels = []
+        families_by_text = defaultdict(list)
+        for family, sub_families in job_categories.items():
+            for sub_family in sub_families:
+                text = normalize_text(sub_family)
+                if text not in families_by_text:
+                    self.labels.append((text, sub_family))
+                families_by_text[text].append(family)
+        self.families = [families_by_text[text] for text, _ in self.labels]
+        self.exact = {text: index for index, (text, _) in enumerate(self.labels)}
+
+        documents = [Counter(char_ngrams(text)) for text, _ in self.labels]
+        document_frequency = Counter(gram for grams in documents for gram in grams)
+        count = len(documents)
+        self.idf = {gram: math.log(count / df) + 1 for gram, df in document_frequency.items()}
+        # Grams never seen in the taxonomy weigh as much as the rarest known gram
+        self.unknown_idf = math.log(count) + 1 if count else 1
+
+        self.postings = defaultdict(list)
+        for index, grams in enumerate(documents):
+            weights = {gram: tf * self.idf[gram] for gram, tf in grams.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            for gram, weight in weights.items():
+                self.postings[gram].append((index, weight / norm))
+
+    def top_matches(self, position, k=3):
+        """
+        Score a position against every sub-family.
+
+        Args:
+            position: The job position title
+            k: Number of matches to return
+
+        Returns:
+            List of (sub_family, families, score) tuples, best first; score is a cosine similarity in [0, 1]
+        """
+        text = normalize_text(position)
+        if text in self.exact:
+            index = self.exact[text]
+            return [(self.labels[index][1], self.families[index], 1.0)]
+
+        grams = Counter(char_ngrams(text))
+        weights = {gram: tf * self.idf.get(gram, self.unknown_idf) for gram, tf in grams.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm:
+            return []
+
+        scores = {}
+        for gram, weight in weights.items():
+            for index, doc_weight in self.postings.get(gram, ()):
+                scores[index] = scores.get(index, 0.0) + weight * doc_weight
+
+        best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        return [(self.labels[index][1], self.families[index], score / norm) for index, score in best]
+
+    def classify(self, position, threshold=0.9, margin=0.05):
+        """
+        Classify a position locally when the match is confident.
+
+        Args:
+            position: The job position title
+            threshold: Minimum similarity of the best sub-family
+            margin: Minimum lead of the best sub-family over the runner-up
+
+        Returns:
+            Tuple of (job_family, job_sub_family, score), or None if the position should go to the API
+        """
+        matches = self.top_matches(position, k=2)
+        if not matches:
+            return None
+
+        sub_family, families, score = matches[0]
+        # A sub-family shared by several families needs the industry context only the LLM can weigh
+        if score < threshold or len(families) != 1:
+            return None
+        if len(matches) > 1 and score - matches[1][2] < margin:
+            return None
+        return families[0], sub_family, score
@@ -1,68 +1,176 @@
 import json
 import os
-import glob
 import argparse
+import asyncio
+import hashlib
+import importlib.util
+import math
+import threading
 import time
 from pathlib import Path
-from openai import AzureOpenAI
 import dotenv
 
+from batch_api import (
+    download_batch_results,
+    load_batch_state,
+    save_batch_state,
+    submit_batch,
+    wait_for_batch,
+    write_batch_file,
+)
+from instrumentation import RunMetrics
+from lexical_classifier import LexicalClassifier
+from mapping_cache import MappingCache
+from normalization import closest_choice, mapping_key, normalize_text
+from rate_limiter import RateLimiter, estimate_tokens, retry_after_seconds
+from record_store import STORAGE_LAYOUTS, load_changes, open_store, shard_of
+from result_writer import WRITE_BATCH_SIZE, ResultWriter
+from run_manifest import RunManifest
+
 # Load environment variables from .env file if it exists
 try:
     dotenv.load_dotenv()
 except:
     pass
 
-endpoint = "https://ai-totrakoolk6076ai346198185670.openai.azure.com/"
+endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", "https://ai-totrakoolk6076ai346198185670.openai.azure.com/")
 model_name = os.getenv("AZURE_OPENAI_MODEL_NAME")
 deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
 subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
 api_version = os.getenv("AZURE_API_VERSION")
 
-client = AzureOpenAI(
-    api_version=api_version,
-    azure_endpoint=endpoint,
-    api_key=subscription_key,
-)
+# Settings read from the environment, restored by configure() for arguments it is not given
+_environment_settings = {
+    "endpoint": endpoint,
+    "deployment": deployment,
+    "subscription_key": subscription_key,
+    "api_version": api_version,
+}
+
+# Constrain answers to the valid categories with a JSON schema; set to false for deployments without structured outputs
+structured_output = os.getenv("AZURE_OPENAI_STRUCTURED_OUTPUT", "true").lower() not in ("0", "false", "no")
+
+# Connection pool of the HTTP clients; requests reuse kept-alive connections instead of reconnecting
+HTTP_MAX_CONNECTIONS = int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = 60
+REQUEST_TIMEOUT = float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+
+# The synchronous client is created on first use, so importing this module needs no credentials
+_client = None
+_client_lock = threading.Lock()
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "mapping_cache.sqlite")
+
+# Expected size of the JSON answer, added to the prompt estimate for the tokens-per-minute quota
+RESPONSE_TOKEN_ESTIMATE = 50
+
+# Number of positions embedded at once when retrieving candidate sub-families
+RETRIEVAL_CHUNK_SIZE = 1000
+
+# Minimum similarity for snapping an invalid family or sub-family name to a valid one
+REPAIR_CUTOFF = 0.8
 
 def load_job_categories():
     """Load job categories from the job-category.json file."""
     with open("job-category.json", "r", encoding="utf-8") as f:
         return json.load(f)
 
-def test_api_connection(client):
-    """Test if the API connection is working with the provided key."""
-    try:
-        response = client.responses.create(
-            model=deployment,
-            input=[{
-                "role": "user",
-                "content": "test"
-            }]
-        )
-        return True
-    except Exception as e:
-        print(f"Error connecting to Azure OpenAI API: {str(e)}")
-        return False
+def compute_taxonomy_hash(job_categories):
+    """Return a stable hash of the job categories, used to invalidate cached mappings."""
+    canonical = json.dumps(job_categories, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
-def map_job_to_family(position, industry, job_categories, client):
+def configure(endpoint=None, deployment=None, api_key=None, api_version=None):
     """
-    Use OpenAI API to map a position and industry to a job family and sub-family.
+    Override the Azure OpenAI settings read from the environment, e.g. to point a worker
+    process at its own deployment. Arguments left as None fall back to the environment
+    settings, never to an earlier configure() call, and the shared client is rebuilt with
+    the new settings on next use.
+    """
+    global _client
+    settings = globals()
+    for name, value in (("endpoint", endpoint), ("deployment", deployment),
+                        ("subscription_key", api_key), ("api_version", api_version)):
+        settings[name] = value if value is not None else _environment_settings[name]
+    with _client_lock:
+        _client = None
+
+def missing_settings():
+    """Return the names of the required Azure OpenAI settings that are not configured."""
+    settings = {
+        "AZURE_OPENAI_API_KEY": subscription_key,
+        "AZURE_API_VERSION": api_version,
+        "AZURE_OPENAI_DEPLOYMENT": deployment,
+    }
+    return [name for name, value in settings.items() if not value]
+
+def http_client_options():
+    """Return the pool limits, timeout and protocol options of the HTTP clients."""
+    import openai
+    # DEFAULT_CONNECTION_LIMITS is an instance of the Limits class of the HTTP library the SDK is built on
+    limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    return {
+        "limits": limits,
+        "timeout": openai.Timeout(REQUEST_TIMEOUT, connect=5.0),
+        # HTTP/2 multiplexes concurrent requests over one connection but needs the h2 package
+        "http2": importlib.util.find_spec("h2") is not None,
+    }
+
+def create_client(async_client=False, **options):
+    """
+    Build an Azure OpenAI client on an explicitly configured, pooled HTTP transport.
     
     Args:
-        position: The job position title
-        industry: The industry of the job
-        job_categories: Dictionary of job families and their sub-families
-        client: OpenAI client instance
+        async_client: Build an AsyncAzureOpenAI client instead of an AzureOpenAI client
+        **options: Further client options, e.g. max_retries
     
     Returns:
-        Tuple of (job_family, job_sub_family)
+        AzureOpenAI or AsyncAzureOpenAI client instance
     """
-    # Create a structured prompt for the model
-    job_families = list(job_categories.keys())
-    
-    system_message = """You are a specialized job classification expert tasked with precisely matching job positions to the SINGLE most relevant job family and job sub-family.
+    # The SDK takes most of a second to import, so it is only loaded once a client is needed
+    import openai
+    if async_client:
+        client_class, http_client_class = openai.AsyncAzureOpenAI, openai.DefaultAsyncHttpxClient
+    else:
+        client_class, http_client_class = openai.AzureOpenAI, openai.DefaultHttpxClient
+    return client_class(
+        api_version=api_version,
+        azure_endpoint=endpoint,
+        api_key=subscription_key,
+        http_client=http_client_class(**http_client_options()),
+        **options,
+    )
+
+def get_client():
+    """Return the shared synchronous client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+def __getattr__(name):
+    # Keeps map_job_families.client working for callers written before the client became lazy
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def test_api_connection(client):
+    """Test if the endpoint accepts the key by listing the models, which costs no tokens."""
+    try:
+        client.with_options(max_retries=0, timeout=10).models.list()
+        return True
+    except Exception as e:
+        print(f"Error connecting to Azure OpenAI API: {str(e)}")
+        return False
+
+SYSTEM_MESSAGE = """You are a specialized job classification expert tasked with precisely matching job positions to the SINGLE most relevant job family and job sub-family.
 
 Your task requires extreme precision and careful consideration. You must:
 1. Thoroughly examine ALL available job sub-families in each job family
@@ -76,20 +184,88 @@ Provide your answer ONLY as a JSON object with exactly two fields: "job_family"
 Both values MUST exist exactly as written in the provided categories list - do not modify or create new categories.
 
 IMPORTANT: Each position must be assigned to EXACTLY ONE job family and ONE job sub-family - the MOST relevant match."""
+
+def render_categories(job_categories):
+    """Render the job families and their sub-families as a markdown list for the prompt."""
+    text = ""
+    for family, sub_families in job_categories.items():
+        text += f"\n## {family}\n"
+        for sub_family in sub_families:
+            text += f"- {sub_family}\n"
+    return text
+
+def build_text_formats(job_categories):
+    """
+    Build the structured output formats of the single and batch answers.
+    
+    The job_family and job_sub_family enums list every valid category, so the model can
+    only answer with names that exist in job-category.json. The enums cannot tie a
+    sub-family to its family; validate_mapping repairs such mismatches.
     
-    prompt = f"""I need to classify the job position: "{position}" in the industry: "{industry}"
+    Returns:
+        Tuple of (single_format, batch_format) for the text.format request parameter
+    """
+    sub_families = list(dict.fromkeys(sub_family for sub_families in job_categories.values() for sub_family in sub_families))
+    properties = {
+        "job_family": {"type": "string", "enum": list(job_categories)},
+        "job_sub_family": {"type": "string", "enum": sub_families},
+    }
+    single_format = {
+        "type": "json_schema",
+        "name": "job_mapping",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": properties,
+            "required": ["job_family", "job_sub_family"],
+            "additionalProperties": False,
+        },
+    }
+    # The root of a schema must be an object, so the batch answer array is wrapped in "results"
+    batch_format = {
+        "type": "json_schema",
+        "name": "job_mappings",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {"id": {"type": "string"}, **properties},
+                        "required": ["id", "job_family", "job_sub_family"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    }
+    return single_format, batch_format
 
-Please determine the SINGLE most appropriate job family and job sub-family from the following categories:
+# Static prompt sections rendered once per taxonomy, keyed by id() of the job categories dictionary
+_compiled_prompts = {}
 
-"""
+def render_prompts(job_categories):
+    """
+    Render the parts of the prompts that do not depend on the row.
     
-    # Add all job families and their sub-families
-    for family, sub_families in job_categories.items():
-        prompt += f"\n## {family}\n"
-        for sub_family in sub_families:
-            prompt += f"- {sub_family}\n"
+    Args:
+        job_categories: Dictionary of job families and their sub-families offered to the model
     
-    prompt += """
+    Returns:
+        Dictionary with the "single_prefix" and "batch_prefix" user prompt prefixes and
+        the "single_format" and "batch_format" structured output formats
+    """
+    categories = render_categories(job_categories)
+    
+    single_prefix = """Please determine the SINGLE most appropriate job family and job sub-family for the job position given at the end of this message, from the following categories:
+
+"""
+    single_prefix += categories
+    single_prefix += """
 Carefully evaluate ALL possible job sub-families to find the ONE closest match to the position title.
 Consider the skills, responsibilities, and domain knowledge typically associated with this position.
 If the industry context provides additional clues, use that information in your decision.
@@ -103,8 +279,327 @@ IMPORTANT: Your response must be a valid JSON object containing ONLY:
 {"job_family": "selected job family", "job_sub_family": "selected job sub-family"}
 
 The selected job family and sub-family MUST exactly match one of the options provided above.
+
+"""
+    
+    batch_prefix = "For each job position listed at the end of this message, determine the SINGLE most appropriate job family and job sub-family from the following categories:\n\n"
+    batch_prefix += categories
+    batch_prefix += """
+Carefully evaluate ALL possible job sub-families to find the ONE closest match to each position title.
+If the industry context provides additional clues, use that information in your decision.
+
+IMPORTANT: Your response must be a valid JSON object whose "results" array contains ONE object per id:
+{"results": [{"id": "id from the list", "job_family": "selected job family", "job_sub_family": "selected job sub-family"}]}
+
+The selected job family and sub-family MUST exactly match one of the options provided above.
+
 """
     
+    single_format, batch_format = build_text_formats(job_categories)
+    
+    return {
+        "single_prefix": single_prefix,
+        "batch_prefix": batch_prefix,
+        "single_format": single_format,
+        "batch_format": batch_format,
+    }
+
+def compile_prompts(job_categories):
+    """
+    Render the parts of the prompts that do not depend on the row, once per run.
+    
+    Everything that is identical across requests (the system message, instructions and
+    the full category list) comes first, so server-side prompt caching can reuse the
+    shared prefix; only the position and industry are appended at the very end.
+    
+    Args:
+        job_categories: Dictionary of job families and their sub-families; it must not be
+            modified in place after the first call
+    
+    Returns:
+        The render_prompts dictionary, plus the "taxonomy_hash"
+    """
+    compiled = _compiled_prompts.get(id(job_categories))
+    if compiled is not None and compiled["job_categories"] is job_categories:
+        return compiled
+    
+    compiled = render_prompts(job_categories)
+    compiled["job_categories"] = job_categories
+    compiled["taxonomy_hash"] = compute_taxonomy_hash(job_categories)
+    _compiled_prompts[id(job_categories)] = compiled
+    return compiled
+
+def candidate_prompts(job_categories, candidates=None):
+    """
+    Return the prompt parts listing either the whole taxonomy or only the retrieved candidates.
+    
+    Candidate lists differ per position, so they are rendered for each request instead of cached.
+    """
+    return render_prompts(candidates) if candidates else compile_prompts(job_categories)
+
+def build_mapping_prompt(position, industry, job_categories, candidates=None):
+    """
+    Build the system message and user prompt used to classify one position.
+    
+    Args:
+        position: The job position title
+        industry: The industry of the job
+        job_categories: Dictionary of job families and their sub-families
+        candidates: Subset of job_categories to list instead of the whole taxonomy, or None
+    
+    Returns:
+        Tuple of (system_message, prompt)
+    """
+    prompt = candidate_prompts(job_categories, candidates)["single_prefix"]
+    prompt += f'I need to classify the job position: "{position}" in the industry: "{industry}"\n'
+    return SYSTEM_MESSAGE, prompt
+
+def response_text_format(job_categories, batch=False, candidates=None):
+    """Return the structured output format of a single or batch request, or None when structured output is disabled."""
+    if not structured_output:
+        return None
+    return candidate_prompts(job_categories, candidates)["batch_format" if batch else "single_format"]
+
+def extract_response_text(response):
+    """Return the text of a Responses API result, or None if it cannot be found."""
+    # First check if the output attribute exists
+    if hasattr(response, 'output_text'):
+        return response.output_text
+    # If output_text doesn't exist, check if there's an output array with content
+    if hasattr(response, 'output') and response.output:
+        # Extract the text from the first message's content
+        for item in response.output:
+            if hasattr(item, 'content') and item.content:
+                for content_item in item.content:
+                    if hasattr(content_item, 'text'):
+                        return content_item.text
+    return None
+
+def validate_mapping(result, position, job_categories):
+    """
+    Check a parsed answer against the job categories.
+    
+    A family or sub-family name that is close to a valid one (a different case, punctuation
+    or a small typo, or a sub-family paired with the wrong spelling) is snapped to the nearest
+    valid name of the returned family, which is much cheaper than asking again.
+    
+    Args:
+        result: Dictionary parsed from the model response
+        position: The job position title, used in warnings
+        job_categories: Dictionary of job families and their sub-families
+    
+    Returns:
+        Tuple of (job_family, job_sub_family); invalid values are None
+    """
+    if "job_family" not in result:
+        print(f"Warning: Response missing job_family field for position '{position}'")
+        return None, None
+        
+    if "job_sub_family" not in result:
+        print(f"Warning: Response missing job_sub_family field for position '{position}'")
+        return None, None
+        
+    job_family = result["job_family"]
+    if job_family not in job_categories:
+        job_family = closest_choice(job_family, job_categories, REPAIR_CUTOFF)
+        if job_family is None:
+            print(f"Warning: API returned invalid job family for position '{position}': {result['job_family']}")
+            return None, None
+        print(f"  Repaired job family '{result['job_family']}' to '{job_family}' for position '{position}'")
+        metrics.count("repairs")
+        
+    job_sub_family = result["job_sub_family"]
+    if job_sub_family not in job_categories[job_family]:
+        job_sub_family = closest_choice(job_sub_family, job_categories[job_family], REPAIR_CUTOFF)
+        if job_sub_family is None:
+            print(f"Warning: API returned invalid job sub-family for position '{position}': {result['job_sub_family']}")
+            return job_family, None
+        print(f"  Repaired job sub-family '{result['job_sub_family']}' to '{job_sub_family}' for position '{position}'")
+        metrics.count("repairs")
+        
+    return job_family, job_sub_family
+
+def parse_mapping_response(response, position, job_categories):
+    """
+    Extract, parse and validate the job family mapping from an API response.
+    
+    Args:
+        response: Result of client.responses.create()
+        position: The job position title, used in warnings
+        job_categories: Dictionary of job families and their sub-families
+    
+    Returns:
+        Tuple of (job_family, job_sub_family)
+    """
+    response_text = extract_response_text(response)
+    
+    if response_text is None:
+        print(f"Warning: Could not extract text from response for position '{position}'")
+        print(f"Response structure: {response}")
+        return None, None
+    
+    return parse_mapping_text(response_text, position, job_categories)
+
+def parse_mapping_text(response_text, position, job_categories):
+    """
+    Parse and validate the text of an answer to a single-position prompt.
+    
+    Args:
+        response_text: Output text of the model
+        position: The job position title, used in warnings
+        job_categories: Dictionary of job families and their sub-families
+    
+    Returns:
+        Tuple of (job_family, job_sub_family)
+    """
+    try:
+        # Try to parse the response text as JSON
+        if response_text and '{' in response_text:
+            # Extract JSON object from text if it's embedded in other text
+            start_index = response_text.find('{')
+            end_index = response_text.rfind('}') + 1
+            if start_index >= 0 and end_index > start_index:
+                json_str = response_text[start_index:end_index]
+                result = json.loads(json_str)
+            else:
+                # If no JSON object found, use the whole text
+                result = json.loads(response_text)
+        else:
+            print(f"Warning: Response does not contain a JSON object for position '{position}'")
+            print(f"Response text: {response_text}")
+            return None, None
+            
+    except json.JSONDecodeError as e:
+        print(f"Error parsing JSON response for position '{position}': {str(e)}")
+        print(f"Response text: {response_text}")
+        return None, None
+    except Exception as e:
+        print(f"Unexpected error processing response for position '{position}': {str(e)}")
+        return None, None
+    
+    # Verify that the response contains valid job family and sub-family
+    return validate_mapping(result, position, job_categories)
+
+BATCH_SYSTEM_MESSAGE = """You are a specialized job classification expert tasked with precisely matching job positions to the SINGLE most relevant job family and job sub-family.
+
+You will receive a numbered list of job positions. For EACH position you must:
+1. Thoroughly examine ALL available job sub-families in each job family
+2. Consider both the position title AND industry context
+3. Find the SINGLE MOST SPECIFIC and RELEVANT match possible
+4. Select ONLY ONE job family and ONE job sub-family - not multiple options
+5. Never select a generic category when a more specific match exists
+6. Consider job responsibilities, skills, and domain knowledge implied by the position title
+
+Provide your answer ONLY as a JSON object with a "results" array holding one object per position, each with exactly three fields: "id", "job_family" and "job_sub_family".
+The "id" must be copied from the input list. Both category values MUST exist exactly as written in the provided categories list - do not modify or create new categories."""
+
+def build_batch_prompt(items, job_categories, candidates=None):
+    """
+    Build the system message and user prompt used to classify several positions in one request.
+    
+    Args:
+        items: List of (item_id, position, industry) tuples
+        job_categories: Dictionary of job families and their sub-families
+        candidates: Subset of job_categories to list instead of the whole taxonomy, or None
+    
+    Returns:
+        Tuple of (system_message, prompt)
+    """
+    prompt = candidate_prompts(job_categories, candidates)["batch_prefix"]
+    prompt += "I need to classify the following job positions:\n\n"
+    for item_id, position, industry in items:
+        prompt += f'- id "{item_id}": position "{position}" in the industry "{industry}"\n'
+    return BATCH_SYSTEM_MESSAGE, prompt
+
+def parse_batch_response(response, items, job_categories):
+    """
+    Parse and validate the answer to a batch prompt.
+    
+    Args:
+        response: Result of client.responses.create()
+        items: List of (item_id, position, industry) tuples that were sent
+        job_categories: Dictionary of job families and their sub-families
+    
+    Returns:
+        Dictionary mapping item_id to (job_family, job_sub_family); items that are
+        missing or invalid in the answer are left out so they can be retried
+    """
+    return parse_batch_text(extract_response_text(response), items, job_categories)
+
+def parse_batch_text(response_text, items, job_categories):
+    """
+    Parse and validate the text of an answer to a batch prompt.
+    
+    Args:
+        response_text: Output text of the model
+        items: List of (item_id, position, industry) tuples that were sent
+        job_categories: Dictionary of job families and their sub-families
+    
+    Returns:
+        Dictionary mapping item_id to (job_family, job_sub_family) for the valid answers
+    """
+    if not response_text or '[' not in response_text:
+        print(f"Warning: Batch response does not contain a JSON array for {len(items)} positions")
+        return {}
+    
+    try:
+        # The prompt and schema ask for {"results": [...]}; slicing also accepts a bare array
+        start_index = response_text.find('[')
+        end_index = response_text.rfind(']') + 1
+        answers = json.loads(response_text[start_index:end_index])
+    except json.JSONDecodeError as e:
+        print(f"Error parsing JSON batch response: {str(e)}")
+        print(f"Response text: {response_text}")
+        return {}
+    
+    positions = {str(item_id): position for item_id, position, _ in items}
+    results = {}
+    for answer in answers if isinstance(answers, list) else []:
+        if not isinstance(answer, dict) or str(answer.get("id")) not in positions:
+            continue
+        item_id = str(answer["id"])
+        job_family, job_sub_family = validate_mapping(answer, positions[item_id], job_categories)
+        if job_family and job_sub_family:
+            results[item_id] = (job_family, job_sub_family)
+    return results
+
+# Stage timings, request latencies, token usage and counters of the current run
+metrics = RunMetrics("mapping")
+
+def record_usage(response):
+    """Add the token usage of a response, including prompt-cache hits, to the run metrics."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    metrics.count("requests")
+    metrics.count("input_tokens", getattr(usage, "input_tokens", 0) or 0)
+    metrics.count("cached_tokens", getattr(details, "cached_tokens", 0) or 0)
+    metrics.count("output_tokens", getattr(usage, "output_tokens", 0) or 0)
+
+def print_usage_summary():
+    """Print the token usage of the run and how much of the prompt was served from the prompt cache."""
+    requests = metrics.counters.get("requests", 0)
+    if not requests:
+        return
+    input_tokens = metrics.counters.get("input_tokens", 0)
+    cached_tokens = metrics.counters.get("cached_tokens", 0)
+    cached_share = cached_tokens / input_tokens if input_tokens else 0
+    print(f"Token usage: {requests} requests, {input_tokens} input tokens "
+          f"({cached_tokens} cached, {cached_share:.1%}), {metrics.counters.get('output_tokens', 0)} output tokens")
+
+def request_mapping(system_message, prompt, client, label, text_format=None):
+    """
+    Send one classification request.
+    
+    Args:
+        text_format: Structured output format of the answer, or None for free text
+    
+    Returns:
+        The API response, or None if the call failed
+    """
+    options = {"text": {"format": text_format}} if text_format else {}
+    start = time.perf_counter()
     try:
         # Call OpenAI API using the response.create() endpoint with proper input format
         response = client.responses.create(
@@ -118,145 +613,758 @@ The selected job family and sub-family MUST exactly match one of the options pro
                     "role": "user",
                     "content": prompt
                 }
-            ]
+            ],
+            **options
         )
-        
-        # Debug output to understand the response structure
+    except Exception as e:
+        print(f"Error calling Azure OpenAI API for {label}: {str(e)}")
+        metrics.count("api_errors")
+        return None
+    
+    metrics.observe_request(time.perf_counter() - start)
+    record_usage(response)
+    return response
+
+async def request_mapping_async(system_message, prompt, client, limiter, label, text_format=None, max_retries=5):
+    """
+    Async version of request_mapping that respects the rate limiter and retries on 429 responses.
+
+    The async client is created without SDK retries so 429s go through the shared limiter;
+    connection errors, timeouts and 5xx responses are retried here with exponential backoff.
+    
+    Returns:
+        The API response, or None if the call failed
+    """
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    
+    options = {"text": {"format": text_format}} if text_format else {}
+    estimated_tokens = estimate_tokens(system_message) + estimate_tokens(prompt) + RESPONSE_TOKEN_ESTIMATE
+    
+    for attempt in range(max_retries + 1):
+        with metrics.stage("rate_limit_wait"):
+            await limiter.acquire(estimated_tokens)
+        start = time.perf_counter()
         try:
-            # First check if the output attribute exists
-            if hasattr(response, 'output_text'):
-                response_text = response.output_text
-            # If output_text doesn't exist, check if there's an output array with content
-            elif hasattr(response, 'output') and response.output:
-                # Extract the text from the first message's content
-                for item in response.output:
-                    if hasattr(item, 'content') and item.content:
-                        for content_item in item.content:
-                            if hasattr(content_item, 'text'):
-                                response_text = content_item.text
-                                break
-                        if 'response_text' in locals():
-                            break
-            
-            if 'response_text' not in locals():
-                print(f"Warning: Could not extract text from response for position '{position}'")
-                print(f"Response structure: {response}")
-                return None, None
-            
-            # Try to parse the response text as JSON
-            if response_text and '{' in response_text:
-                # Extract JSON object from text if it's embedded in other text
-                start_index = response_text.find('{')
-                end_index = response_text.rfind('}') + 1
-                if start_index >= 0 and end_index > start_index:
-                    json_str = response_text[start_index:end_index]
-                    result = json.loads(json_str)
-                else:
-                    # If no JSON object found, use the whole text
-                    result = json.loads(response_text)
-            else:
-                print(f"Warning: Response does not contain a JSON object for position '{position}'")
-                print(f"Response text: {response_text}")
-                return None, None
-                
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response for position '{position}': {str(e)}")
-            print(f"Response text: {response_text}")
-            return None, None
+            response = await client.responses.create(
+                model=deployment,
+                input=[
+                    {
+                        "role": "system",
+                        "content": system_message
+                    },
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                **options
+            )
+        except RateLimitError as e:
+            delay = retry_after_seconds(e, default=min(2 ** attempt, 60))
+            print(f"Rate limited for {label}, retrying in {delay:.1f}s")
+            metrics.count("rate_limited")
+            limiter.pause(delay)
+            continue
+        except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+            if attempt == max_retries:
+                print(f"Error calling Azure OpenAI API for {label}: {str(e)}")
+                metrics.count("api_errors")
+                return None
+            delay = min(2 ** attempt, 60)
+            print(f"Transient error for {label} ({str(e)}), retrying in {delay:.1f}s")
+            metrics.count("api_retries")
+            await asyncio.sleep(delay)
+            continue
         except Exception as e:
-            print(f"Unexpected error processing response for position '{position}': {str(e)}")
-            return None, None
+            print(f"Error calling Azure OpenAI API for {label}: {str(e)}")
+            metrics.count("api_errors")
+            return None
         
-        # Verify that the response contains valid job family and sub-family
-        if "job_family" not in result:
-            print(f"Warning: Response missing job_family field for position '{position}'")
-            return None, None
-            
-        if "job_sub_family" not in result:
-            print(f"Warning: Response missing job_sub_family field for position '{position}'")
-            return None, None
-            
-        if result["job_family"] not in job_categories:
-            print(f"Warning: API returned invalid job family for position '{position}': {result['job_family']}")
-            return None, None
-            
-        if result["job_sub_family"] not in job_categories[result["job_family"]]:
-            print(f"Warning: API returned invalid job sub-family for position '{position}': {result['job_sub_family']}")
-            return result["job_family"], None
+        metrics.observe_request(time.perf_counter() - start)
+        usage = getattr(response, "usage", None)
+        limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+        record_usage(response)
+        return response
+    
+    print(f"Error: Giving up on {label} after {max_retries} rate-limited retries")
+    return None
+
+def map_job_to_family(position, industry, job_categories, client, candidates=None):
+    """
+    Use OpenAI API to map a position and industry to a job family and sub-family.
+    
+    Args:
+        position: The job position title
+        industry: The industry of the job
+        job_categories: Dictionary of job families and their sub-families
+        client: OpenAI client instance
+        candidates: Subset of job_categories to offer the model instead of the whole taxonomy, or None
+    
+    Returns:
+        Tuple of (job_family, job_sub_family)
+    """
+    system_message, prompt = build_mapping_prompt(position, industry, job_categories, candidates)
+    response = request_mapping(system_message, prompt, client, f"position '{position}'",
+                               response_text_format(job_categories, candidates=candidates))
+    if response is None:
+        return None, None
+    with metrics.stage("validate"):
+        return parse_mapping_response(response, position, job_categories)
+
+async def map_job_to_family_async(position, industry, job_categories, client, limiter, candidates=None):
+    """
+    Async version of map_job_to_family that respects the rate limiter and retries on 429 responses.
+    
+    Args:
+        position: The job position title
+        industry: The industry of the job
+        job_categories: Dictionary of job families and their sub-families
+        client: AsyncAzureOpenAI client instance
+        limiter: RateLimiter shared by all concurrent requests
+        candidates: Subset of job_categories to offer the model instead of the whole taxonomy, or None
+    
+    Returns:
+        Tuple of (job_family, job_sub_family)
+    """
+    system_message, prompt = build_mapping_prompt(position, industry, job_categories, candidates)
+    response = await request_mapping_async(system_message, prompt, client, limiter, f"position '{position}'",
+                                           response_text_format(job_categories, candidates=candidates))
+    if response is None:
+        return None, None
+    with metrics.stage("validate"):
+        return parse_mapping_response(response, position, job_categories)
+
+def map_jobs_to_families_batch(items, job_categories, client, candidates=None):
+    """
+    Map several positions with a single API call.
+    Items that the batch answer leaves missing or invalid are retried one at a time.
+    
+    Args:
+        items: List of (item_id, position, industry) tuples
+        job_categories: Dictionary of job families and their sub-families
+        client: OpenAI client instance
+        candidates: Subset of job_categories to offer the model instead of the whole taxonomy, or None
+    
+    Returns:
+        Dictionary mapping item_id to (job_family, job_sub_family)
+    """
+    system_message, prompt = build_batch_prompt(items, job_categories, candidates)
+    response = request_mapping(system_message, prompt, client, f"a batch of {len(items)} positions",
+                               response_text_format(job_categories, True, candidates))
+    with metrics.stage("validate"):
+        results = parse_batch_response(response, items, job_categories) if response is not None else {}
+    
+    for item_id, position, industry in items:
+        if str(item_id) not in results:
+            print(f"  Retrying '{position}' individually")
+            metrics.count("retries")
+            results[str(item_id)] = map_job_to_family(position, industry, job_categories, client, candidates)
+    return results
+
+async def map_jobs_to_families_batch_async(items, job_categories, client, limiter, candidates=None):
+    """
+    Async version of map_jobs_to_families_batch.
+    
+    Args:
+        items: List of (item_id, position, industry) tuples
+        job_categories: Dictionary of job families and their sub-families
+        client: AsyncAzureOpenAI client instance
+        limiter: RateLimiter shared by all concurrent requests
+        candidates: Subset of job_categories to offer the model instead of the whole taxonomy, or None
+    
+    Returns:
+        Dictionary mapping item_id to (job_family, job_sub_family)
+    """
+    system_message, prompt = build_batch_prompt(items, job_categories, candidates)
+    response = await request_mapping_async(system_message, prompt, client, limiter, f"a batch of {len(items)} positions",
+                                           response_text_format(job_categories, True, candidates))
+    with metrics.stage("validate"):
+        results = parse_batch_response(response, items, job_categories) if response is not None else {}
+    
+    for item_id, position, industry in items:
+        if str(item_id) not in results:
+            print(f"  Retrying '{position}' individually")
+            metrics.count("retries")
+            results[str(item_id)] = await map_job_to_family_async(position, industry, job_categories, client, limiter, candidates)
+    return results
+
+# Field names that may hold the position, tried in order
+POSITION_FIELD_NAMES = ["Position", "[Position]", "position", "ตำแหน่ง"]
+
+def find_position(data):
+    """
+    Find the position title in a row, trying every alias in POSITION_FIELD_NAMES.
+    Field names are also compared after normalization, so "[ Position ]" or "POSITION" match too.
+    """
+    for field_name in POSITION_FIELD_NAMES:
+        if field_name in data and data[field_name]:
+            return data[field_name]
+    
+    aliases = {normalize_text(field_name) for field_name in POSITION_FIELD_NAMES}
+    for field_name, value in data.items():
+        if value and normalize_text(field_name) in aliases:
+            return value
+    return None
+
+def plan_mapping(store, row_ids):
+    """
+    Read every record once and group the rows by normalized position and industry,
+    so that each distinct title is classified a single time.
+    
+    Args:
+        store: Record store holding the rows
+        row_ids: Identifiers of the rows to map
+    
+    Returns:
+        Tuple of (groups, skipped): groups maps each mapping key to a dictionary with the
+        first seen "position" and "industry" and the list of matching "rows"; skipped is
+        the number of rows that have no position
+    """
+    groups = {}
+    skipped = 0
+    for row_id, data in store.iter_records(row_ids, with_mappings=False):
+        position = find_position(data)
+        industry = data.get("Industry", "")
+        
+        if not position:
+            print(f"Warning: No position found in row {row_id}, skipping")
+            skipped += 1
+            continue
+        
+        key = mapping_key(position, industry)
+        if key not in groups:
+            groups[key] = {"position": position, "industry": industry, "rows": []}
+        groups[key]["rows"].append(row_id)
+    return groups, skipped
+
+def print_plan_statistics(groups, cached, local, positions_per_call):
+    """Print how many rows, distinct keys and API calls the plan involves before any tokens are spent."""
+    rows = sum(len(group["rows"]) for group in groups.values())
+    unique = len(groups)
+    pending = unique - len(cached) - len(local)
+    api_calls = math.ceil(pending / positions_per_call)
+    
+    print(f"Dedupe plan: {rows} rows share {unique} unique position/industry keys"
+          + (f" ({rows / unique:.1f} rows per key)" if unique else ""))
+    print(f"  {len(cached)} keys answered from the cache, {len(local)} by the local classifier")
+    print(f"  {pending} keys to classify in about {api_calls} API calls")
+    print(f"  Estimated API calls saved: {rows - api_calls} of {rows}")
+
+def retrieve_candidates(keys, groups, job_categories, taxonomy_hash, retrieval, k, cache_dir):
+    """
+    Store the k most similar sub-families of every key in groups[key]["candidates"].
+    
+    Args:
+        keys: Mapping keys to retrieve candidates for
+        groups: The plan returned by plan_mapping
+        job_categories: Dictionary of job families and their sub-families
+        taxonomy_hash: Hash of job_categories, identifying the cached sub-family matrix
+        retrieval: Embedding backend, "local" (hashed character n-grams) or "azure"
+        k: Number of candidate sub-families per position
+        cache_dir: Directory of the cached sub-family matrix
+    """
+    # NumPy is only imported by runs that use retrieval
+    from embedding_retrieval import AzureEmbedder, HashingEmbedder, SubFamilyIndex
+    
+    if retrieval == "azure":
+        embedder = AzureEmbedder(get_client(), os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-small"))
+    else:
+        embedder = HashingEmbedder()
+    index = SubFamilyIndex(job_categories, embedder, taxonomy_hash, cache_dir)
+    
+    # Positions are embedded in chunks so the similarity matrix stays small
+    for start in range(0, len(keys), RETRIEVAL_CHUNK_SIZE):
+        chunk = keys[start:start + RETRIEVAL_CHUNK_SIZE]
+        for key, candidates in zip(chunk, index.candidates([groups[key]["position"] for key in chunk], k)):
+            groups[key]["candidates"] = candidates
+    if retrieval == "azure":
+        metrics.count("embedding_requests", embedder.requests)
+    print(f"Retrieved the {k} closest sub-families of {len(keys)} positions with {embedder.name}")
+
+def chunk_candidates(keys, groups, job_categories):
+    """
+    Return the union of the retrieved candidates of several keys, in taxonomy order,
+    or None when any key has no candidates and the whole taxonomy must be offered.
+    """
+    chosen = set()
+    for key in keys:
+        candidates = groups[key].get("candidates")
+        if candidates is None:
+            return None
+        chosen.update((family, sub_family) for family, sub_families in candidates.items() for sub_family in sub_families)
+    merged = {}
+    for family, sub_families in job_categories.items():
+        kept = [sub_family for sub_family in sub_families if (family, sub_family) in chosen]
+        if kept:
+            merged[family] = kept
+    return merged
+
+def resolve_pending(keys, groups, job_categories, client):
+    """Map a chunk of distinct keys, batching them into one request when there are several."""
+    candidates = chunk_candidates(keys, groups, job_categories)
+    if len(keys) == 1:
+        group = groups[keys[0]]
+        return {keys[0]: map_job_to_family(group["position"], group["industry"], job_categories, client, candidates)}
+    items = [(key, groups[key]["position"], groups[key]["industry"]) for key in keys]
+    return map_jobs_to_families_batch(items, job_categories, client, candidates)
+
+async def resolve_pending_async(keys, groups, job_categories, client, limiter):
+    """Async version of resolve_pending."""
+    candidates = chunk_candidates(keys, groups, job_categories)
+    if len(keys) == 1:
+        group = groups[keys[0]]
+        return {keys[0]: await map_job_to_family_async(group["position"], group["industry"], job_categories, client, limiter, candidates)}
+    items = [(key, groups[key]["position"], groups[key]["industry"]) for key in keys]
+    return await map_jobs_to_families_batch_async(items, job_categories, client, limiter, candidates)
+
+def apply_results(results, groups, writer, cache=None, source=None):
+    """
+    Fan the result of every key out to all of its rows.
+    
+    Args:
+        results: Dictionary mapping keys to (job_family, job_sub_family)
+        groups: The plan returned by plan_mapping
+        writer: ResultWriter that writes and journals the rows in the background
+        cache: MappingCache that receives new complete API answers, or None
+        source: "cached" or "local" when the results did not come from the API
+    """
+    for key, (job_family, job_sub_family) in results.items():
+        group = groups[key]
+        # Only complete answers are cached so failed mappings are retried next run
+        if cache and not source and job_family and job_sub_family:
+            with metrics.stage("cache_write"):
+                cache.put(group["position"], group["industry"], job_family, job_sub_family)
+        
+        for row_id in group["rows"]:
+            writer.put(row_id, job_family, job_sub_family)
+        metrics.count("rows_mapped" if job_family and job_sub_family else "rows_unmapped", len(group["rows"]))
+        
+        print(f"  Mapped '{group['position']}' to {job_family} / {job_sub_family} "
+              f"({len(group['rows'])} rows{', ' + source if source else ''})")
+
+async def process_files_async(chunks, groups, writer, job_categories, cache, concurrency, requests_per_minute, tokens_per_minute):
+    """
+    Map chunks of distinct keys concurrently with AsyncAzureOpenAI.
+    
+    Args:
+        chunks: List of lists of mapping keys; each chunk is classified in one request
+        groups: The plan returned by plan_mapping
+        writer: ResultWriter receiving the mapping results
+        job_categories: Dictionary of job families and their sub-families
+        cache: MappingCache instance or None
+        concurrency: Maximum number of requests in flight
+        requests_per_minute: Requests-per-minute quota, or None for no limit
+        tokens_per_minute: Tokens-per-minute quota, or None for no limit
+    """
+    # Retries are handled here so that 429 responses honour Retry-After and pause every worker
+    async_client = create_client(async_client=True, max_retries=0)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    queue = asyncio.Queue()
+    for chunk in chunks:
+        queue.put_nowait(chunk)
+    
+    async def worker():
+        while True:
+            try:
+                chunk = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
             
-        return result["job_family"], result["job_sub_family"]
+            results = await resolve_pending_async(chunk, groups, job_categories, async_client, limiter)
+            apply_results(results, groups, writer, cache)
+    
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        await async_client.close()
+
+def build_batch_api_request(items, job_categories, candidates=None):
+    """Return the Responses API request body of one batch input line classifying the given items."""
+    if len(items) == 1:
+        _, position, industry = items[0]
+        system_message, prompt = build_mapping_prompt(position, industry, job_categories, candidates)
+    else:
+        system_message, prompt = build_batch_prompt(items, job_categories, candidates)
+    body = {
+        "model": deployment,
+        "input": [
+            {
+                "role": "system",
+                "content": system_message
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    }
+    text_format = response_text_format(job_categories, len(items) > 1, candidates)
+    if text_format:
+        body["text"] = {"format": text_format}
+    return body
+
+def parse_batch_api_result(response_text, items, job_categories):
+    """Validate the answer of one batch input line; returns only the valid (job_family, job_sub_family) results."""
+    if len(items) == 1:
+        key, position, _ = items[0]
+        job_family, job_sub_family = parse_mapping_text(response_text, position, job_categories)
+        return {key: (job_family, job_sub_family)} if job_family and job_sub_family else {}
+    return parse_batch_text(response_text, items, job_categories)
+
+def run_batch_job(requests, job_categories, output_dir, poll_interval, batch_id=None, groups=None):
+    """
+    Submit one Batch API job, or resume an existing one by id, and wait for its results.
+    
+    Args:
+        requests: Dictionary mapping custom_id to a list of (key, position, industry) items;
+            ignored when resuming, since the submitted items are read from the saved batch state
+        job_categories: Dictionary of job families and their sub-families
+        output_dir: Directory receiving the batch input and state files
+        poll_interval: Seconds between status checks
+        batch_id: Identifier of a previously submitted batch to resume
+        groups: The plan returned by plan_mapping, holding the retrieved candidates of each key, or None
+    
+    Returns:
+        Tuple of (requests, results): the requests covered by the job and the valid results keyed by mapping key
+    """
+    if batch_id is None:
+        input_path = os.path.join(output_dir, f"batch_input_{int(time.time() * 1000)}.jsonl")
+        write_batch_file(input_path, {
+            custom_id: build_batch_api_request(
+                items, job_categories, chunk_candidates([key for key, _, _ in items], groups, job_categories) if groups else None)
+            for custom_id, items in requests.items()
+        })
+        batch_id = submit_batch(get_client(), input_path).id
+        metrics.count("batch_jobs")
+        save_batch_state(output_dir, batch_id, requests)
+        print(f"Submitted batch {batch_id} with {len(requests)} requests (resume with --batch_id {batch_id})")
+    else:
+        requests = load_batch_state(output_dir, batch_id)
+        print(f"Resuming batch {batch_id} with {len(requests)} requests")
+    
+    with metrics.stage("batch_wait"):
+        batch = wait_for_batch(get_client(), batch_id, poll_interval)
+    answers = download_batch_results(get_client(), batch)
+    metrics.count("batch_requests", len(requests))
+    
+    results = {}
+    for custom_id, items in requests.items():
+        response_text, error = answers.get(custom_id, (None, "no result returned"))
+        if error:
+            print(f"Warning: Batch request {custom_id} failed: {error}")
+            continue
+        with metrics.stage("validate"):
+            results.update(parse_batch_api_result(response_text, items, job_categories))
+    return requests, results
+
+def process_files_batch_api(chunks, groups, writer, job_categories, cache, output_dir,
+                            poll_interval=60, batch_retries=2, batch_id=None):
+    """
+    Map the pending keys offline with the Azure OpenAI Batch API.
+    
+    Failed or invalid items are resubmitted, one position per request, in up to
+    batch_retries further batch jobs; whatever still fails is written as unmapped.
+    When a batch is resumed, its failed items and the pending keys it does not cover
+    are then submitted as a new job.
+    
+    Args:
+        chunks: List of lists of mapping keys; each chunk becomes one batch request line
+        groups: The plan returned by plan_mapping
+        writer: ResultWriter receiving the mapping results
+        job_categories: Dictionary of job families and their sub-families
+        cache: MappingCache instance or None
+        output_dir: Directory receiving the batch input and state files
+        poll_interval: Seconds between status checks
+        batch_retries: Number of resubmissions for failed items
+        batch_id: Identifier of a previously submitted batch to resume instead of submitting a new one
+    """
+    requests = {
+        f"request-{i}": [(key, groups[key]["position"], groups[key]["industry"]) for key in chunk]
+        for i, chunk in enumerate(chunks)
+    }
+    if batch_id is not None:
+        resumed, results = run_batch_job({}, job_categories, output_dir, poll_interval, batch_id, groups)
+        # A resumed batch may cover rows that are no longer part of this run
+        apply_results({key: result for key, result in results.items() if key in groups}, groups, writer, cache)
         
-    except Exception as e:
-        print(f"Error calling Azure OpenAI API for position '{position}': {str(e)}")
-        return None, None
+        # Pending positions the resumed batch does not cover, e.g. when it was a retry
+        # batch, are submitted in a new job together with the ones it failed on
+        covered = {item[0] for items in resumed.values() for item in items}
+        requests = {
+            custom_id: [item for item in items if item[0] not in covered]
+            for custom_id, items in requests.items()
+        }
+        requests = {custom_id: items for custom_id, items in requests.items() if items}
+        if requests:
+            print(f"Submitting {sum(len(items) for items in requests.values())} pending positions not covered by batch {batch_id}")
+        failed = [item for items in resumed.values() for item in items if item[0] in groups and item[0] not in results]
+        requests.update({f"retry0-{i}": [item] for i, item in enumerate(failed)})
+    if not requests:
+        return
+    
+    failed = []
+    for attempt in range(batch_retries + 1):
+        requests, results = run_batch_job(requests, job_categories, output_dir, poll_interval, groups=groups)
+        apply_results(results, groups, writer, cache)
+        
+        failed = [item for items in requests.values() for item in items if item[0] not in results]
+        if not failed:
+            return
+        if attempt < batch_retries:
+            print(f"Resubmitting {len(failed)} failed positions, one per request")
+            metrics.count("retries", len(failed))
+            requests = {f"retry{attempt + 1}-{i}": [item] for i, item in enumerate(failed)}
+    
+    print(f"Warning: {len(failed)} positions could not be mapped by the Batch API")
+    apply_results({key: (None, None) for key, _, _ in failed}, groups, writer)
 
-def process_files():
-    """Process all row_x.json files in the output directory."""
-    # Test the API connection
-    print("Testing API connection...")
-    if not test_api_connection(client):
-        print("Failed to connect to the Azure OpenAI API. Please check your configuration and try again.")
+def process_files(use_cache=True, cache_path=DEFAULT_CACHE_PATH, cache_size=100000, clear_cache=False,
+                  async_mode=False, concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                  positions_per_call=1, start_index=0, batch_size=None, resume=False,
+                  use_local_classifier=True, local_threshold=0.9, output_dir="output", storage="files",
+                  batch_api=False, batch_id=None, poll_interval=60, batch_retries=2, changed_only=False,
+                  retrieval=None, retrieval_k=20, health_check=False, compact_json=False, write_batch_size=WRITE_BATCH_SIZE,
+                  shard=None):
+    """
+    Map every record in the output directory.
+    
+    Rows are first grouped by normalized position and industry, so each distinct
+    title is classified once and the answer is written to every matching row.
+
+    Args:
+        use_cache: Whether to consult the persistent mapping cache before calling the API
+        cache_path: Path of the SQLite cache database
+        cache_size: Maximum number of cached mappings before LRU eviction
+        clear_cache: Remove all cached mappings first, e.g. after editing job-category.json
+        async_mode: Map rows concurrently instead of one request per second
+        concurrency: Maximum number of requests in flight in async mode
+        requests_per_minute: Requests-per-minute quota enforced in async mode
+        tokens_per_minute: Tokens-per-minute quota enforced in async mode
+        positions_per_call: Number of distinct positions classified together in a single API call
+        start_index: Index of the first row of this shard in the sorted row list
+        batch_size: Number of rows in this shard, or None for all remaining rows
+        resume: Skip rows already completed according to the run journals
+        use_local_classifier: Answer confident exact or near-exact titles without calling the API
+        local_threshold: Minimum similarity for a local answer
+        output_dir: Directory holding the extracted records
+        storage: Record layout, "files" (row_x.json), "jsonl" or "parquet"
+        batch_api: Submit the pending positions as an offline Azure OpenAI Batch API job
+        batch_id: Resume a previously submitted batch job instead of submitting a new one
+        poll_interval: Seconds between batch status checks
+        batch_retries: Number of batch resubmissions for failed items
+        changed_only: Only map the rows that the last incremental extraction wrote
+        retrieval: Offer each position only its retrieval_k closest sub-families, embedded
+            "local"ly or by an "azure" embeddings deployment; None offers the whole taxonomy
+        retrieval_k: Number of candidate sub-families per position
+        health_check: Check the endpoint and key with a models request before any work
+        compact_json: Write row files without indentation
+        write_batch_size: Maximum number of rows the writer stage writes and journals together
+        shard: Tuple of (index, count) to only map the rows whose hashed row id falls in
+            shard index of count, as done by the workers of sharded_mapping.py
+    """
+    missing = missing_settings()
+    if missing:
+        print(f"Missing Azure OpenAI settings: {', '.join(missing)}. Please check your .env file and try again.")
         return
     
-    print("API connection successful!")
+    if health_check:
+        print("Testing API connection...")
+        if not test_api_connection(get_client()):
+            print("Failed to connect to the Azure OpenAI API. Please check your configuration and try again.")
+            return
+        print("API connection successful!")
     
-    # Load job categories
+    # Load job categories and render the static prompt sections once for the whole run
     job_categories = load_job_categories()
+    prompts = compile_prompts(job_categories)
+    metrics.reset()
+    # Counted from zero so runs answered without the API still report their calls per row
+    metrics.count("requests", 0)
     
-    # Get all row_x.json files
-    output_dir = "output"
-    files = glob.glob(os.path.join(output_dir, "row_*.json"))
+    # Open the mapping cache so repeated positions never pay for a second API call
+    cache = None
+    if use_cache:
+        # Hash shards run in parallel processes sharing one cache database
+        cache = MappingCache(cache_path, prompts["taxonomy_hash"], deployment, max_entries=cache_size, shared=shard is not None)
+        if clear_cache:
+            print(f"Clearing mapping cache at {cache_path}")
+            cache.clear()
     
-    print(f"Found {len(files)} files to process")
+    # Get all records (row_x.json files are listed in natural order)
+    store = open_store(output_dir, storage, compact=compact_json)
+    row_ids = store.row_ids()
     
-    for i, file_path in enumerate(files):
-        print(f"Processing file {i+1}/{len(files)}: {file_path}")
-        
-        try:
-            # Load the JSON content with UTF-8 encoding
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            
-            # Extract position and industry
-            # Try multiple possible field names for position
-            position = None
-            position_field_names = ["Position", "[Position]", "position", "ตำแหน่ง"]
-            for field_name in position_field_names:
-                if field_name in data and data[field_name]:
-                    position = data[field_name]
-                    break
-            
-            industry = data.get("Industry", "")
-            
-            if not position:
-                print(f"Warning: No position found in {file_path}, skipping")
-                continue
-            
-            # Map to job family and sub-family
-            job_family, job_sub_family = map_job_to_family(position, industry, job_categories, client)
-            
-            # Update the JSON with mapping
-            data["job_family"] = job_family
-            data["job_sub_family"] = job_sub_family
-            
-            # Save the updated file with UTF-8 encoding
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
-            print(f"  Mapped '{position}' to {job_family} / {job_sub_family}")
+    # Select this process's shard of the sorted row list so several processes can split one directory
+    end_index = len(row_ids) if batch_size is None else start_index + batch_size
+    row_ids = row_ids[start_index:end_index]
+    
+    # Hash and range shards write their own mapping results file and journal
+    shard_name = None
+    if shard:
+        shard_name = f"hash{shard[0]}of{shard[1]}"
+    elif batch_size is not None or start_index:
+        shard_name = f"{start_index}-{end_index}"
+    if shard_name:
+        store = open_store(output_dir, storage, compact=compact_json, shard_name=shard_name)
+    if shard:
+        row_ids = [row_id for row_id in row_ids if shard_of(row_id, shard[1]) == shard[0]]
+    
+    if changed_only:
+        changes = load_changes(output_dir)
+        if changes is None:
+            print("The last extraction was not incremental; mapping every row")
+        else:
+            changed = set(changes["new"]) | set(changes["modified"])
+            row_ids = [row_id for row_id in row_ids if row_id in changed]
+            print(f"Mapping only the {len(row_ids)} rows new or modified in the last extraction")
+    
+    # Every written row is journaled so that an interrupted run can be resumed
+    manifest = RunManifest(output_dir, shard_name=shard_name or "all")
+    if resume:
+        remaining = [row_id for row_id in row_ids if not manifest.is_done(row_id)]
+        print(f"Resuming: {len(row_ids) - len(remaining)} rows already completed")
+        row_ids = remaining
+    
+    # Results are written in the background so API calls never wait for the disk
+    writer = ResultWriter(store, manifest, write_batch_size, metrics=metrics)
+    
+    print(f"Found {len(row_ids)} rows to process")
+    metrics.count("rows", len(row_ids))
+    
+    # Plan the run: group rows by position and check each distinct key against the cache once
+    with metrics.stage("plan"):
+        groups, skipped = plan_mapping(store, row_ids)
+    cached = {}
+    if cache:
+        with metrics.stage("cache_lookup"):
+            for key, group in groups.items():
+                hit = cache.get(group["position"], group["industry"])
+                if hit:
+                    cached[key] = hit
+    
+    # Titles that closely match a sub-family name are answered in-process
+    local = {}
+    if use_local_classifier:
+        with metrics.stage("local_classify"):
+            classifier = LexicalClassifier(job_categories)
+            for key, group in groups.items():
+                if key in cached:
+                    continue
+                match = classifier.classify(group["position"], threshold=local_threshold)
+                if match:
+                    local[key] = match[:2]
+    metrics.count("unique_keys", len(groups))
+    metrics.count("local_answers", len(local))
+    
+    positions_per_call = max(1, positions_per_call)
+    print_plan_statistics(groups, cached, local, positions_per_call)
+    if skipped:
+        print(f"  {skipped} rows skipped because they have no position")
+    
+    apply_results(cached, groups, writer, source="cached")
+    apply_results(local, groups, writer, source="local")
+    
+    # The distinct keys of each chunk share one API call
+    pending = [key for key in groups if key not in cached and key not in local]
+    chunks = [pending[i:i + positions_per_call] for i in range(0, len(pending), positions_per_call)]
+    
+    if retrieval and pending:
+        with metrics.stage("retrieval"):
+            retrieve_candidates(pending, groups, job_categories, prompts["taxonomy_hash"], retrieval, retrieval_k,
+                                os.path.dirname(cache_path) or ".cache")
+    
+    if batch_api or batch_id:
+        process_files_batch_api(chunks, groups, writer, job_categories, cache, output_dir,
+                                poll_interval, batch_retries, batch_id)
+    elif async_mode:
+        print(f"Mapping {len(pending)} keys with up to {concurrency} concurrent requests")
+        asyncio.run(process_files_async(chunks, groups, writer, job_categories, cache, concurrency, requests_per_minute, tokens_per_minute))
+    else:
+        for i, chunk in enumerate(chunks):
+            print(f"Processing request {i+1}/{len(chunks)}")
+            results = resolve_pending(chunk, groups, job_categories, get_client())
+            apply_results(results, groups, writer, cache)
             
             # Add a small delay to respect API rate limits
-            time.sleep(1)
-            
-        except Exception as e:
-            print(f"Error processing file {file_path}: {str(e)}")
+            with metrics.stage("throttle_sleep"):
+                time.sleep(1)
+    
+    if cache:
+        stats = cache.stats()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions "
+              f"({stats['hit_rate']:.1%} hit rate, {stats['entries']} entries)")
+        metrics.count("cache_hits", stats["hits"])
+        metrics.count("cache_misses", stats["misses"])
+        cache.close()
+    with metrics.stage("write_flush"):
+        writer.close()
+    manifest.close()
+    store.close()
+    print_usage_summary()
     
     print("Processing complete!")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Map job positions to job families using Azure OpenAI API")
-    parser.add_argument("--batch_size", type=int, default=20, help="Number of files to process in one batch.")
-    parser.add_argument("--start_index", type=int, default=0, help="Index of the first file to process.")
+    parser.add_argument("--batch_size", type=int, default=None, help="Number of rows in this shard of the sorted row list (default: all).")
+    parser.add_argument("--start_index", type=int, default=0, help="Index of the first row of this shard in the sorted row list.")
+    parser.add_argument("--resume", action="store_true", help="Skip rows already completed according to the run journals.")
+    parser.add_argument("--output", type=str, default="output", help="Directory holding the extracted records.")
+    parser.add_argument("--storage", choices=STORAGE_LAYOUTS, default="files", help="Record layout: one row_x.json per record, a single JSONL file, or Parquet.")
+    parser.add_argument("--changed_only", action="store_true", help="Only map rows that the last incremental extraction added or modified.")
+    parser.add_argument("--batch_api", action="store_true", help="Map offline with the Azure OpenAI Batch API instead of synchronous calls.")
+    parser.add_argument("--batch_id", type=str, default=None, help="Resume a previously submitted Batch API job.")
+    parser.add_argument("--poll_interval", type=int, default=60, help="Seconds between Batch API status checks.")
+    parser.add_argument("--batch_retries", type=int, default=2, help="Number of Batch API resubmissions for failed items.")
+    parser.add_argument("--no_structured_output", action="store_true", help="Ask for free-text JSON instead of schema-constrained answers.")
+    parser.add_argument("--no_local", action="store_true", help="Send every position to the API instead of answering close matches locally.")
+    parser.add_argument("--local_threshold", type=float, default=0.9, help="Minimum similarity (0-1) for the local classifier to answer a position.")
+    parser.add_argument("--no_cache", action="store_true", help="Disable the persistent mapping cache.")
+    parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="Path of the SQLite mapping cache.")
+    parser.add_argument("--cache_size", type=int, default=100000, help="Maximum number of cached mappings before LRU eviction.")
+    parser.add_argument("--clear_cache", action="store_true", help="Invalidate the mapping cache, e.g. after job-category.json changes.")
+    parser.add_argument("--async_mode", action="store_true", help="Map rows concurrently with AsyncAzureOpenAI.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of requests in flight in async mode.")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests-per-minute quota of the deployment (async mode).")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens-per-minute quota of the deployment (async mode).")
+    parser.add_argument("--compact_json", action="store_true", help="Write row files without indentation.")
+    parser.add_argument("--write_batch_size", type=int, default=WRITE_BATCH_SIZE, help="Maximum number of rows written and journaled together.")
+    parser.add_argument("--health_check", action="store_true", help="Check the endpoint and key with a models request before mapping.")
+    parser.add_argument("--report", type=str, default=None, help="Path of the JSON run report (default: <output>/run_report_mapping.json).")
+    parser.add_argument("--prometheus", type=str, default=None, help="Also write the run metrics in Prometheus text format to this path.")
+    parser.add_argument("--retrieval", choices=["local", "azure"], default=None, help="Only offer each position its closest sub-families, embedded locally or with an Azure embeddings deployment.")
+    parser.add_argument("--retrieval_k", type=int, default=20, help="Number of candidate sub-families per position with --retrieval.")
+    parser.add_argument("--positions_per_call", type=int, default=1, help="Number of distinct positions classified in one API call.")
     
     args = parser.parse_args()
-    process_files() 
\ No newline at end of file
+    if args.no_structured_output:
+        structured_output = False
+    process_files(
+        use_cache=not args.no_cache,
+        cache_path=args.cache_path,
+        cache_size=args.cache_size,
+        clear_cache=args.clear_cache,
+        async_mode=args.async_mode,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        positions_per_call=args.positions_per_call,
+        start_index=args.start_index,
+        batch_size=args.batch_size,
+        resume=args.resume,
+        use_local_classifier=not args.no_local,
+        local_threshold=args.local_threshold,
+        output_dir=args.output,
+        storage=args.storage,
+        batch_api=args.batch_api,
+        batch_id=args.batch_id,
+        poll_interval=args.poll_interval,
+        batch_retries=args.batch_retries,
+        changed_only=args.changed_only,
+        retrieval=args.retrieval,
+        retrieval_k=args.retrieval_k,
+        health_check=args.health_check,
+        compact_json=args.compact_json,
+        write_batch_size=args.write_batch_size,
+    )
+    metrics.write_report(args.report or os.path.join(args.output, "run_report_mapping.json"), args.prometheus)
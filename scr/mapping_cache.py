@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import time
+
+from normalization import mapping_key
+
+class MappingCache:
+    """
+    Disk-backed cache of job family mappings stored in SQLite.
+
+    Entries are keyed by the normalized position/industry pair together with
+    the hash of job-category.json and the deployment name, so a change to
+    either never serves a stale answer. When the number of entries exceeds
+    max_entries the least recently used ones are evicted.
+
+    Lookups only note the keys they used; their last_used times are written
+    together with the next commit, so reading never holds the write lock.
+    """
+
+    def __init__(self, path, taxonomy_hash, deployment, max_entries=100000, commit_every=100, shared=False):
+        """
+        Open (or create) the cache database.
+
+        Args:
+            path: Path of the SQLite database file
+            taxonomy_hash: Hash of the job categories currently in use
+            deployment: Name of the Azure OpenAI deployment answering requests
+            max_entries: Maximum number of entries kept before LRU eviction
+            commit_every: Number of writes between commits to disk
+            shared: Whether other processes use the database at the same time; it is then
+                opened in WAL mode and every write is committed at once, so no process
+                keeps the write lock while it waits for the API
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.taxonomy_hash = taxonomy_hash
+        self.deployment = deployment or ""
+        self.max_entries = max_entries
+        self.commit_every = 1 if shared else commit_every
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending_writes = 0
+        self._touched = {}
+
+        self.conn = sqlite3.connect(path, timeout=30)
+        if shared:
+            # Readers never block the writer, and writers only wait for each other's short commits
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS mappings (
+                key TEXT NOT NULL,
+                taxonomy_hash TEXT NOT NULL,
+                deployment TEXT NOT NULL,
+                job_family TEXT,
+                job_sub_family TEXT,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (key, taxonomy_hash, deployment)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_mappings_last_used ON mappings (last_used)")
+        self.conn.commit()
+        self._size = self.conn.execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+
+    def _key_params(self, position, industry):
+        return (mapping_key(position, industry), self.taxonomy_hash, self.deployment)
+
+    def get(self, position, industry):
+        """
+        Look up a cached mapping.
+
+        Args:
+            position: The job position title
+            industry: The industry of the job
+
+        Returns:
+            Tuple of (job_family, job_sub_family), or None on a cache miss
+        """
+        params = self._key_params(position, industry)
+        try:
+            row = self.conn.execute(
+                "SELECT job_family, job_sub_family FROM mappings "
+                "WHERE key = ? AND taxonomy_hash = ? AND deployment = ?",
+                params,
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            print(f"Warning: mapping cache lookup failed, treating it as a miss: {str(e)}")
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched[params] = time.time()
+        return row[0], row[1]
+
+    def put(self, position, industry, job_family, job_sub_family):
+        """
+        Store a mapping, evicting the least recently used entries if the cache is full.
+
+        Args:
+            position: The job position title
+            industry: The industry of the job
+            job_family: The mapped job family
+            job_sub_family: The mapped job sub-family
+        """
+        params = self._key_params(position, industry)
+        try:
+            exists = self.conn.execute(
+                "SELECT 1 FROM mappings WHERE key = ? AND taxonomy_hash = ? AND deployment = ?",
+                params,
+            ).fetchone()
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mappings "
+                "(key, taxonomy_hash, deployment, job_family, job_sub_family, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                params + (job_family, job_sub_family, time.time()),
+            )
+            if not exists:
+                self._size += 1
+                self._evict()
+            self._record_write()
+        except sqlite3.OperationalError as e:
+            # A busy cache only costs a later API call; the mapping itself is still written
+            print(f"Warning: could not store the mapping of '{position}' in the cache: {str(e)}")
+            self.conn.rollback()
+            self._pending_writes = 0
+
+    def _evict(self):
+        """Remove the least recently used entries beyond max_entries."""
+        excess = self._size - self.max_entries
+        if excess <= 0:
+            return
+        self.conn.execute(
+            "DELETE FROM mappings WHERE rowid IN "
+            "(SELECT rowid FROM mappings ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        )
+        self._size -= excess
+        self.evictions += excess
+
+    def _record_write(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        """Write the last_used times of the entries read since the previous commit, then commit."""
+        if self._touched:
+            self.conn.executemany(
+                "UPDATE mappings SET last_used = ? WHERE key = ? AND taxonomy_hash = ? AND deployment = ?",
+                [(last_used,) + params for params, last_used in self._touched.items()],
+            )
+            self._touched = {}
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def clear(self):
+        """Remove every entry, e.g. after the job taxonomy has changed."""
+        self.conn.execute("DELETE FROM mappings")
+        self.conn.commit()
+        self._size = 0
+
+    def stats(self):
+        """Return a dictionary with the cache counters for this run."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._size,
+        }
+
+    def close(self):
+        """Commit pending writes and close the database."""
+        try:
+            self._commit()
+        except sqlite3.OperationalError as e:
+            print(f"Warning: could not save the mapping cache usage times: {str(e)}")
+        self.conn.close()
@@ -0,0 +1,340 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import map_job_families as mapper
+from instrumentation import RunMetrics
+from lexical_classifier import LexicalClassifier
+from normalization import mapping_key
+
+# Maximum number of positions accepted in one HTTP request
+MAX_ITEMS_PER_REQUEST = 1000
+
+# Seconds a request waits for its answer before it is reported as unmapped
+ANSWER_TIMEOUT = 120
+
+# Number of most recent request latencies the reported percentiles cover
+LATENCY_WINDOW = 10000
+
+# Queued by close() to stop the dispatcher thread
+_STOP = object()
+
+class LRUCache:
+    """Thread-safe in-memory least recently used cache of mapping results."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value of a key, or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry if the cache is full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class MappingService:
+    """
+    Classifies positions for online callers with the prompts and validation of map_job_families.py.
+
+    Answers come, in order of preference, from an in-memory LRU cache, the local lexical
+    classifier or the model. Requests for a key that is already being classified wait for
+    that call instead of starting another, and keys arriving within a short window are
+    sent together as one batch prompt, so a burst of traffic costs few upstream calls.
+    """
+
+    def __init__(self, job_categories, client=None, window=0.02, max_batch=20, concurrency=8,
+                 cache_size=10000, use_local_classifier=True, local_threshold=0.9):
+        """
+        Start the dispatcher thread.
+
+        Args:
+            job_categories: Dictionary of job families and their sub-families
+            client: AzureOpenAI client instance; the shared lazy client when None
+            window: Seconds the dispatcher waits for more keys before sending a batch
+            max_batch: Maximum number of positions per upstream call
+            concurrency: Maximum number of upstream calls in flight
+            cache_size: Maximum number of answers kept in the LRU cache
+            use_local_classifier: Answer confident exact or near-exact titles without calling the API
+            local_threshold: Minimum similarity for a local answer
+        """
+        self.job_categories = job_categories
+        self.client = client
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.cache = LRUCache(cache_size)
+        self.classifier = LexicalClassifier(job_categories) if use_local_classifier else None
+        self.local_threshold = local_threshold
+        self.metrics = RunMetrics("service", latency_window=LATENCY_WINDOW)
+        # Every upstream call is also timed in mapper.metrics, which /metrics exports too
+        mapper.metrics.latency_window = LATENCY_WINDOW
+        mapper.metrics.reset()
+        # Render the static prompt sections before the first request arrives
+        mapper.compile_prompts(job_categories)
+
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="mapping")
+        self._dispatcher = threading.Thread(target=self._dispatch, name="mapping-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, position, industry):
+        """
+        Start classifying one position without waiting for the answer.
+
+        Returns:
+            Future resolving to a dictionary with "job_family", "job_sub_family" and
+            "source" ("cache", "local", "model" or "unmapped")
+        """
+        future = Future()
+        if not position:
+            future.set_result({"job_family": None, "job_sub_family": None, "source": "unmapped"})
+            return future
+
+        key = mapping_key(position, industry)
+        hit = self.cache.get(key)
+        if hit:
+            self.metrics.count("lru_hits")
+            future.set_result({"job_family": hit[0], "job_sub_family": hit[1], "source": "cache"})
+            return future
+
+        if self.classifier:
+            match = self.classifier.classify(position, threshold=self.local_threshold)
+            if match:
+                self.metrics.count("local_answers")
+                self.cache.put(key, match[:2])
+                future.set_result({"job_family": match[0], "job_sub_family": match[1], "source": "local"})
+                return future
+
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self.metrics.count("coalesced")
+                return inflight
+            self._inflight[key] = future
+        self.metrics.count("lru_misses")
+        self._queue.put((key, position, industry))
+        return future
+
+    def classify(self, items):
+        """
+        Classify several positions.
+
+        Args:
+            items: List of (position, industry) tuples
+
+        Returns:
+            List of result dictionaries in the order of items
+        """
+        start = time.perf_counter()
+        futures = [self.submit(position, industry) for position, industry in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=ANSWER_TIMEOUT))
+            except Exception as e:
+                print(f"Error classifying a position: {str(e)}")
+                results.append({"job_family": None, "job_sub_family": None, "source": "unmapped"})
+        self.metrics.count("positions", len(items))
+        self.metrics.observe_request(time.perf_counter() - start, stage="request")
+        return results
+
+    def _dispatch(self):
+        """Group queued keys into batches of up to max_batch keys collected within the window."""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._executor.submit(self._resolve, batch)
+
+    def _resolve(self, batch):
+        """Classify a batch of keys with one upstream call and answer everyone waiting for them."""
+        client = self.client or mapper.get_client()
+        self.metrics.count("upstream_batches")
+        try:
+            if len(batch) == 1:
+                _, position, industry = batch[0]
+                results = {"0": mapper.map_job_to_family(position, industry, self.job_categories, client)}
+            else:
+                items = [(str(i), position, industry) for i, (_, position, industry) in enumerate(batch)]
+                results = mapper.map_jobs_to_families_batch(items, self.job_categories, client)
+        except Exception as e:
+            print(f"Error classifying a batch of {len(batch)} positions: {str(e)}")
+            results = {}
+
+        for i, (key, _, _) in enumerate(batch):
+            job_family, job_sub_family = results.get(str(i)) or (None, None)
+            # Only complete answers are cached so failed mappings are retried by the next request
+            if job_family and job_sub_family:
+                self.cache.put(key, (job_family, job_sub_family))
+            with self._lock:
+                future = self._inflight.pop(key)
+            future.set_result({
+                "job_family": job_family,
+                "job_sub_family": job_sub_family,
+                "source": "model" if job_family and job_sub_family else "unmapped",
+            })
+
+    def stats(self):
+        """Return the service counters and the size of the LRU cache."""
+        report = self.metrics.report()
+        return {"cache_entries": len(self.cache), "counters": report["counters"], "request_latency": report["request_latency"]}
+
+    def close(self):
+        """Stop the dispatcher after the queued keys are sent and wait for the upstream calls."""
+        self._queue.put(_STOP)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+def parse_items(body):
+    """
+    Read the positions of a classification request.
+
+    Accepts {"position": ..., "industry": ...} or {"items": [{"position": ..., "industry": ...}, ...]}.
+
+    Returns:
+        Tuple of (items, single): the list of (position, industry) tuples and whether a single position was sent
+
+    Raises:
+        ValueError: If the body is not a valid classification request
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+    single = "items" not in body
+    entries = [body] if single else body["items"]
+    if not isinstance(entries, list) or len(entries) > MAX_ITEMS_PER_REQUEST:
+        raise ValueError(f"'items' must be a list of at most {MAX_ITEMS_PER_REQUEST} positions")
+    items = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("position"), str):
+            raise ValueError("Every item needs a 'position' string")
+        items.append((entry["position"], str(entry.get("industry") or "")))
+    return items, single
+
+class MappingServiceHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a MappingService: POST /classify, GET /health and GET /metrics."""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, body, status=200):
+        self.send_body(json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json", status)
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if path != "/classify":
+            return self.send_json({"error": f"Unknown path {path}"}, 404)
+        try:
+            items, single = parse_items(json.loads(body))
+        except (ValueError, KeyError) as e:
+            return self.send_json({"error": str(e)}, 400)
+        results = self.service.classify(items)
+        self.send_json(results[0] if single else {"results": results})
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/health":
+            return self.send_json({"status": "ok", **self.service.stats()})
+        if path == "/metrics":
+            text = self.service.metrics.to_prometheus(prefix="job_mapping_service") + mapper.metrics.to_prometheus()
+            return self.send_body(text.encode("utf-8"), "text/plain; version=0.0.4")
+        self.send_json({"error": f"Unknown path {path}"}, 404)
+
+class MappingServiceServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 resets connections during bursts
+    request_queue_size = 128
+    daemon_threads = True
+
+def start_service(service, host="127.0.0.1", port=0):
+    """
+    Serve a MappingService over HTTP in a background thread.
+
+    Args:
+        service: The MappingService answering requests
+        host: Interface to listen on
+        port: Port to listen on; 0 picks a free port
+
+    Returns:
+        The server; server.shutdown() stops it
+    """
+    server = MappingServiceServer((host, port), MappingServiceHandler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve job family mappings over HTTP for online callers.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("--window_ms", type=float, default=20, help="Milliseconds to collect positions into one upstream call.")
+    parser.add_argument("--max_batch", type=int, default=20, help="Maximum number of positions per upstream call.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of upstream calls in flight.")
+    parser.add_argument("--cache_size", type=int, default=10000, help="Maximum number of answers kept in memory.")
+    parser.add_argument("--no_local", action="store_true", help="Send every position to the API instead of answering close matches locally.")
+    parser.add_argument("--local_threshold", type=float, default=0.9, help="Minimum similarity (0-1) for the local classifier to answer a position.")
+    parser.add_argument("--no_structured_output", action="store_true", help="Ask for free-text JSON instead of schema-constrained answers.")
+    args = parser.parse_args()
+
+    missing = mapper.missing_settings()
+    if missing:
+        raise SystemExit(f"Missing Azure OpenAI settings: {', '.join(missing)}. Please check your .env file and try again.")
+    if args.no_structured_output:
+        mapper.structured_output = False
+
+    service = MappingService(mapper.load_job_categories(), window=args.window_ms / 1000, max_batch=args.max_batch,
+                             concurrency=args.concurrency, cache_size=args.cache_size,
+                             use_local_classifier=not args.no_local, local_threshold=args.local_threshold)
+    server = start_service(service, args.host, args.port)
+    print(f"Mapping service listening on http://{args.host}:{server.server_address[1]}/")
+    print('POST /classify with {"position": ..., "industry": ...} or {"items": [...]}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        service.close()
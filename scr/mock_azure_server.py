@@ -0,0 +1,332 @@
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from embedding_retrieval import HashingEmbedder
+from lexical_classifier import LexicalClassifier
+
+# Patterns of the positions in the single and batch user prompts built by map_job_families.py
+SINGLE_POSITION = re.compile(r'I need to classify the job position: "(.*)" in the industry: "(.*)"')
+BATCH_POSITION = re.compile(r'- id "(.*?)": position "(.*)" in the industry "(.*)"')
+
+def load_categories(path="job-category.json"):
+    """Load the job categories the stand-in model answers with."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class MockAzureState:
+    """
+    State shared by all requests of one stand-in server: the answering classifier,
+    the uploaded files and batch jobs, and the injected latency and failures.
+    """
+
+    def __init__(self, job_categories, latency=0.0, rate_limit=0.0, retry_after=1, batch_failure_rate=0.0, seed=0):
+        """
+        Args:
+            job_categories: Dictionary of job families and their sub-families
+            latency: Seconds added to every Responses API call
+            rate_limit: Fraction of Responses API calls answered with HTTP 429
+            retry_after: Seconds sent in the Retry-After header of a 429 response
+            batch_failure_rate: Fraction of batch request lines that fail
+            seed: Seed of the random generator deciding injected failures
+        """
+        self.classifier = LexicalClassifier(job_categories)
+        self.embedder = HashingEmbedder()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.batch_failure_rate = batch_failure_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.counts = {"responses": 0, "rate_limited": 0, "batches": 0, "embeddings": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def answer(self, position):
+        """Return the best (job_family, job_sub_family) for a position by lexical similarity."""
+        matches = self.classifier.top_matches(position, k=1)
+        if not matches:
+            sub_family, families = self.classifier.labels[0][1], self.classifier.families[0]
+        else:
+            sub_family, families, _ = matches[0]
+        return families[0], sub_family
+
+    def answer_prompt(self, prompt, structured=False):
+        """
+        Return the output text a well-behaved model would give for a mapping prompt.
+        With structured output, batch answers are wrapped in {"results": [...]} as the schema requires.
+        """
+        batch = BATCH_POSITION.findall(prompt)
+        if batch:
+            answers = []
+            for item_id, position, _ in batch:
+                job_family, job_sub_family = self.answer(position)
+                answers.append({"id": item_id, "job_family": job_family, "job_sub_family": job_sub_family})
+            return json.dumps({"results": answers} if structured else answers, ensure_ascii=False)
+        match = SINGLE_POSITION.search(prompt)
+        job_family, job_sub_family = self.answer(match.group(1) if match else prompt)
+        return json.dumps({"job_family": job_family, "job_sub_family": job_sub_family}, ensure_ascii=False)
+
+    def response_body(self, request):
+        """Build a Responses API result for a request body."""
+        messages = request.get("input")
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        prompt = messages[-1]["content"] if messages else ""
+        text_format = (request.get("text") or {}).get("format") or {}
+        text = self.answer_prompt(prompt, text_format.get("type") == "json_schema")
+        input_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4 + 1
+        output_tokens = len(text) // 4 + 1
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": "completed",
+            "model": request.get("model", "mock"),
+            "output": [{
+                "type": "message",
+                "id": f"msg_{uuid.uuid4().hex}",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                # Everything but the per-row tail of the prompt is a shared, cacheable prefix
+                "input_tokens_details": {"cached_tokens": max(input_tokens - 64, 0) // 128 * 128},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    def embeddings_body(self, request):
+        """Build an embeddings result from the local hashed n-gram embedder."""
+        texts = request.get("input")
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = self.embedder.embed(texts)
+        # The SDK asks for base64 float32 vectors by default and decodes them itself
+        base64_encoded = request.get("encoding_format") == "base64"
+        tokens = sum(len(text) for text in texts) // 4 + 1
+        return {
+            "object": "list",
+            "data": [{
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii") if base64_encoded else vector.tolist(),
+            } for i, vector in enumerate(vectors)],
+            "model": request.get("model", "mock"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def add_file(self, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": f"{file_id}.jsonl",
+                "purpose": purpose,
+                "status": "processed",
+                "content": content,
+            }
+        return file_id
+
+    def file_info(self, file_id):
+        return {k: v for k, v in self.files[file_id].items() if k != "content"}
+
+    def create_batch(self, request):
+        """Register a batch job and run it in a background thread."""
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request.get("endpoint"),
+            "input_file_id": request.get("input_file_id"),
+            "completion_window": request.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        self.count("batches")
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        outputs, errors = [], []
+        for line in lines:
+            time.sleep(self.latency)
+            if self.chance(self.batch_failure_rate):
+                errors.append({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 500, "body": {"error": {"message": "Injected failure"}}},
+                    "error": {"code": "server_error", "message": "Injected failure"},
+                })
+                batch["request_counts"]["failed"] += 1
+                continue
+            outputs.append({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "body": self.response_body(line["body"])},
+                "error": None,
+            })
+            batch["request_counts"]["completed"] += 1
+        if outputs:
+            batch["output_file_id"] = self.add_file(
+                "".join(json.dumps(o, ensure_ascii=False) + "\n" for o in outputs).encode("utf-8"), "batch_output")
+        if errors:
+            batch["error_file_id"] = self.add_file(
+                "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in errors).encode("utf-8"), "batch_output")
+        batch["status"] = "completed"
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    """Routes the Azure OpenAI endpoints used by this project; the deployment and api-version are ignored."""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bytes(self, data):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.read_body()
+        if path.endswith("/responses"):
+            self.state.count("responses")
+            if self.state.chance(self.state.rate_limit):
+                self.state.count("rate_limited")
+                return self.send_json({"error": {"code": "429", "message": "Rate limit is exceeded."}}, 429, {
+                    "Retry-After": str(math.ceil(self.state.retry_after)),
+                    "retry-after-ms": str(int(self.state.retry_after * 1000)),
+                })
+            time.sleep(self.state.latency)
+            return self.send_json(self.state.response_body(json.loads(body)))
+        if path.endswith("/embeddings"):
+            self.state.count("embeddings")
+            return self.send_json(self.state.embeddings_body(json.loads(body)))
+        if path.endswith("/files"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body)
+            fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                      for part in message.iter_parts()}
+            file_id = self.state.add_file(fields.get("file", b""), (fields.get("purpose") or b"").decode("utf-8"))
+            return self.send_json(self.state.file_info(file_id))
+        if path.endswith("/batches"):
+            return self.send_json(self.state.create_batch(json.loads(body)))
+        self.send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/models"):
+            return self.send_json({"object": "list", "data": [
+                {"id": "mock", "object": "model", "created": 0, "owned_by": "mock"},
+            ]})
+        match = re.search(r"/files/([^/]+)/content$", path)
+        if match and match.group(1) in self.state.files:
+            return self.send_bytes(self.state.files[match.group(1)]["content"])
+        match = re.search(r"/files/([^/]+)$", path)
+        if match and match.group(1) in self.state.files:
+            return self.send_json(self.state.file_info(match.group(1)))
+        match = re.search(r"/batches/([^/]+)$", path)
+        if match and match.group(1) in self.state.batches:
+            return self.send_json(self.state.batches[match.group(1)])
+        self.send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+class MockAzureServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 adds SYN retransmits to the measured latency under concurrency
+    request_queue_size = 128
+    daemon_threads = True
+
+def start_mock_server(job_categories, port=0, **options):
+    """
+    Start the stand-in server in a background thread.
+
+    Args:
+        job_categories: Dictionary of job families and their sub-families
+        port: Port to listen on; 0 picks a free port
+        **options: Latency and failure injection options of MockAzureState
+
+    Returns:
+        The server; its endpoint is f"http://127.0.0.1:{server.server_address[1]}/" and
+        server.shutdown() stops it
+    """
+    server = MockAzureServer(("127.0.0.1", port), MockAzureHandler)
+    server.state = MockAzureState(job_categories, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in Azure OpenAI server for running the mapping pipeline offline.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--categories", type=str, default="job-category.json", help="Job categories to answer with.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--rate_limit", type=float, default=0.0, help="Fraction of responses answered with HTTP 429.")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Delay in seconds requested by 429 responses.")
+    parser.add_argument("--batch_failure_rate", type=float, default=0.0, help="Fraction of batch request lines that fail.")
+    args = parser.parse_args()
+
+    server = start_mock_server(load_categories(args.categories), args.port, latency=args.latency,
+                               rate_limit=args.rate_limit, retry_after=args.retry_after,
+                               batch_failure_rate=args.batch_failure_rate)
+    print(f"Mock Azure OpenAI server listening on http://127.0.0.1:{server.server_address[1]}/")
+    print("Run the scripts with AZURE_OPENAI_ENDPOINT set to this address")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
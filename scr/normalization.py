@@ -0,0 +1,65 @@
+import difflib
+import re
+import unicodedata
+
+# Thai punctuation that Unicode classifies as letters (paiyannoi, fongman, angkhankhu, khomut)
+THAI_PUNCTUATION = "ฯ๏๚๛"
+
+# Punctuation that carries meaning in job titles, e.g. "R&D", "C++", "C#"
+KEPT_PUNCTUATION = "&+#"
+
+def strip_punctuation(text):
+    """Replace Thai and English punctuation with spaces, keeping characters that matter in titles."""
+    return "".join(
+        " " if (unicodedata.category(ch).startswith("P") or ch in THAI_PUNCTUATION) and ch not in KEPT_PUNCTUATION else ch
+        for ch in text
+    )
+
+def normalize_text(text):
+    """
+    Normalize free text so that trivially different spellings compare equal.
+    Applies Unicode NFKC folding (full-width letters, ligatures), lowercases the text,
+    replaces punctuation with spaces and collapses runs of whitespace into a single space.
+
+    Args:
+        text: Any value; None becomes an empty string
+
+    Returns:
+        The normalized string
+    """
+    if text is None:
+        return ""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    return re.sub(r"\s+", " ", strip_punctuation(text)).strip()
+
+def mapping_key(position, industry):
+    """
+    Build the lookup key for a (position, industry) pair.
+
+    Args:
+        position: The job position title
+        industry: The industry of the job
+
+    Returns:
+        A single string combining the normalized position and industry
+    """
+    return f"{normalize_text(position)}|{normalize_text(industry)}"
+
+def closest_choice(value, choices, cutoff=0.8):
+    """
+    Snap a free-text value to the most similar of a fixed set of choices.
+
+    Args:
+        value: The text to snap, e.g. a sub-family name returned by the model
+        choices: The valid values
+        cutoff: Minimum similarity ratio (0 to 1) of a fuzzy match
+
+    Returns:
+        The matching choice, or None if no choice is similar enough
+    """
+    by_text = {normalize_text(choice): choice for choice in choices}
+    text = normalize_text(value)
+    if text in by_text:
+        return by_text[text]
+    matches = difflib.get_close_matches(text, list(by_text), n=1, cutoff=cutoff)
+    return by_text[matches[0]] if matches else None
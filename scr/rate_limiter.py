@@ -0,0 +1,114 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in a text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+def retry_after_seconds(error, default):
+    """
+    Read the delay requested by a 429 response.
+
+    Args:
+        error: The exception raised by the OpenAI client
+        default: Delay in seconds to use when the response carries no hint
+
+    Returns:
+        Number of seconds to wait before retrying
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+
+    return default
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+    A bucket created with rate_per_minute=None never limits.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute or 0
+        self.fill_rate = rate_per_minute / 60 if rate_per_minute else None
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Return how many seconds to wait until amount tokens are available."""
+        if not self.capacity:
+            return 0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.fill_rate
+
+    def consume(self, amount):
+        """Take amount tokens from the bucket. The balance may go negative after an adjustment."""
+        if self.capacity:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta):
+        """Charge (positive) or refund (negative) tokens once the real usage is known."""
+        if self.capacity:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+class RateLimiter:
+    """
+    Async limiter enforcing requests-per-minute and tokens-per-minute quotas.
+    After a 429 response every caller is paused until the Retry-After delay has passed.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        """Wait until one request carrying the estimated number of tokens may be sent."""
+        async with self._lock:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay <= 0:
+                    delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket with the usage reported by the API."""
+        if actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def pause(self, seconds):
+        """Block all callers for the given number of seconds, e.g. after a 429 response."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
@@ -0,0 +1,372 @@
+import glob
+import json
+import os
+import re
+import time
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STORAGE_LAYOUTS = ["files", "jsonl", "parquet"]
+
+RECORDS_JSONL = "records.jsonl"
+RECORDS_PARQUET = "records.parquet"
+MAPPINGS_JSONL = "mappings.jsonl"
+
+# Written by extract_data.py: per-row content fingerprints and the rows changed by the last run
+FINGERPRINTS_JSON = "extract_fingerprints.json"
+CHANGES_JSON = "extract_changes.json"
+
+# Number of records buffered before a Parquet row group is written
+PARQUET_ROW_GROUP_SIZE = 10000
+
+def loads(text):
+    """Parse JSON text or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # e.g. integers beyond 64 bits or a byte order mark; let the standard library decide
+            pass
+    return json.loads(text)
+
+def dump_json_atomic(path, data, indent=2):
+    """
+    Write JSON to a temporary file next to path and rename it over path.
+
+    The rename is atomic, so a process killed mid-write leaves either the old or the new
+    file and never a truncated one. indent=None writes compact JSON without spaces.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False, separators=(",", ":") if indent is None else None)
+    os.replace(tmp_path, path)
+
+def load_changes(directory):
+    """
+    Load the rows changed by the last incremental extraction into a directory.
+
+    Returns:
+        Dictionary with "new", "modified" and "deleted" lists of row identifiers,
+        or None if the last extraction was a full one (every row may have changed)
+    """
+    path = os.path.join(directory, CHANGES_JSON)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        changes = json.load(f)
+    return None if changes.get("full") else changes
+
+def shard_of(row_id, shards):
+    """
+    Return the shard (0 to shards - 1) a row belongs to.
+    The hash is stable across processes and hosts, unlike the built-in hash().
+    """
+    return zlib.crc32(str(row_id).encode("utf-8")) % shards
+
+def natural_sort_key(s):
+    """
+    Sort strings that contain numbers in natural order.
+    For example, row_10.json comes after row_2.json, not after row_1.json.
+    """
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+
+class JsonFileStore:
+    """
+    The original layout: one row_<id>.json file per record.
+    Mapping results are written into the record file itself.
+    """
+
+    layout = "files"
+
+    def __init__(self, directory, indent=2):
+        """
+        Args:
+            directory: Directory holding the row files
+            indent: Indentation of the written JSON, or None for compact files
+        """
+        self.directory = directory
+        self.indent = indent
+
+    def path(self, row_id):
+        """Return the path of the file holding a record."""
+        return os.path.join(self.directory, f"row_{row_id}.json")
+
+    def reset(self):
+        """Nothing to do: record files are overwritten one by one."""
+        os.makedirs(self.directory, exist_ok=True)
+
+    def row_ids(self):
+        """Return the identifiers of all records in natural order."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = [f for f in os.listdir(self.directory) if f.endswith('.json') and f.startswith('row_')]
+        names.sort(key=natural_sort_key)
+        return [name[len("row_"):-len(".json")] for name in names]
+
+    def read(self, row_id):
+        """Load one record."""
+        with open(self.path(row_id), "rb") as f:
+            return loads(f.read())
+
+    def iter_records(self, row_ids=None, with_mappings=True, on_error=print):
+        """
+        Yield (row_id, data) for every record, or for the given row_ids in that order.
+        Files that cannot be parsed are reported through on_error and skipped.
+        """
+        for row_id in self.row_ids() if row_ids is None else row_ids:
+            try:
+                yield row_id, self.read(row_id)
+            except json.JSONDecodeError:
+                on_error(f"Error decoding JSON from row_{row_id}.json, skipping...")
+            except Exception as e:
+                on_error(f"Error processing row_{row_id}.json: {str(e)}")
+
+    def write_record(self, row_id, data):
+        """Write one extracted record, atomically replacing any previous version."""
+        dump_json_atomic(self.path(row_id), data, self.indent)
+
+    def delete(self, row_id):
+        """Remove the file of a record that no longer exists in the source."""
+        if os.path.exists(self.path(row_id)):
+            os.remove(self.path(row_id))
+
+    def write_mapping(self, row_id, job_family, job_sub_family):
+        """Add the mapped job family and sub-family to a record file."""
+        data = self.read(row_id)
+        data["job_family"] = job_family
+        data["job_sub_family"] = job_sub_family
+        self.write_record(row_id, data)
+
+    def write_mappings(self, mappings, on_error=print):
+        """
+        Write a batch of (row_id, job_family, job_sub_family) results.
+        Rows that cannot be written are reported through on_error and left out of the result.
+
+        Returns:
+            The mappings that were written
+        """
+        written = []
+        for mapping in mappings:
+            try:
+                self.write_mapping(*mapping)
+            except Exception as e:
+                on_error(f"Error writing mapping of row {mapping[0]}: {str(e)}")
+                continue
+            written.append(mapping)
+        return written
+
+    def close(self):
+        pass
+
+class JsonlStore:
+    """
+    Single-file layout: every record is one line of records.jsonl.
+    Mapping results are appended to mappings.jsonl instead of rewriting the records;
+    the most recently written mapping of a row wins. Processes mapping separate shards
+    append to their own mappings_<shard>.jsonl, since concurrent appends to one file can interleave.
+    """
+
+    layout = "jsonl"
+
+    def __init__(self, directory, shard_name=None):
+        """
+        Args:
+            directory: Directory holding the records
+            shard_name: Name of the shard whose mapping results this store writes, or None
+        """
+        self.directory = directory
+        self.records_path = os.path.join(directory, RECORDS_JSONL)
+        self.mappings_path = os.path.join(directory, f"mappings_{shard_name}.jsonl" if shard_name else MAPPINGS_JSONL)
+        self._records_file = None
+        self._mappings_file = None
+
+    def reset(self):
+        """Start a new extraction: remove existing records and mapping results."""
+        os.makedirs(self.directory, exist_ok=True)
+        for path in [self.records_path] + self._mappings_paths():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _iter_raw(self, on_error=print):
+        if not os.path.exists(self.records_path):
+            return
+        with open(self.records_path, "rb") as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    yield loads(line)
+                except json.JSONDecodeError:
+                    on_error(f"Error decoding JSON on line {line_number} of {self.records_path}, skipping...")
+
+    def row_ids(self):
+        """Return the identifiers of all records in the order they were extracted."""
+        return [entry["row_id"] for entry in self._iter_raw()]
+
+    def _mappings_paths(self):
+        """Return the mapping result files of all shards."""
+        return sorted(glob.glob(os.path.join(self.directory, "mappings*.jsonl")))
+
+    def load_mappings(self):
+        """
+        Return a dictionary of the latest mapping result of every row.
+
+        Every line carries the time it was written, so the newest entry wins whichever
+        shard's file holds it; within a file, later lines win ties. The result holds one
+        entry per mapped row, so memory grows with the number of mapped rows.
+        """
+        mappings = {}
+        recorded_at = {}
+        for path in self._mappings_paths():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    row_id = entry.pop("row_id")
+                    written_at = entry.pop("time", 0)
+                    if written_at >= recorded_at.get(row_id, 0):
+                        recorded_at[row_id] = written_at
+                        mappings[row_id] = entry
+        return mappings
+
+    def iter_records(self, row_ids=None, with_mappings=True, on_error=print):
+        """
+        Yield (row_id, data) for every record in stored order, optionally only for the given row_ids.
+        With with_mappings, the latest mapping result is merged into each record.
+        """
+        wanted = set(row_ids) if row_ids is not None else None
+        mappings = self.load_mappings() if with_mappings else {}
+        for entry in self._iter_raw(on_error):
+            row_id = entry["row_id"]
+            if wanted is not None and row_id not in wanted:
+                continue
+            data = entry["data"]
+            data.update(mappings.get(row_id, {}))
+            yield row_id, data
+
+    def write_record(self, row_id, data):
+        """Append one extracted record."""
+        if self._records_file is None:
+            self._records_file = open(self.records_path, "a", encoding="utf-8")
+        self._records_file.write(json.dumps({"row_id": str(row_id), "data": data}, ensure_ascii=False) + "\n")
+
+    def write_mapping(self, row_id, job_family, job_sub_family):
+        """Append the mapping result of one row."""
+        if self._mappings_file is None:
+            self._mappings_file = open(self.mappings_path, "a", encoding="utf-8")
+        self.write_mappings([(row_id, job_family, job_sub_family)])
+
+    def write_mappings(self, mappings, on_error=print):
+        """
+        Append a batch of (row_id, job_family, job_sub_family) results with a single write.
+        A crash can only truncate the last line, which load_mappings skips.
+
+        Returns:
+            The mappings that were written
+        """
+        if self._mappings_file is None:
+            self._mappings_file = open(self.mappings_path, "a", encoding="utf-8")
+        now = time.time()
+        self._mappings_file.write("".join(json.dumps({
+            "row_id": str(row_id),
+            "job_family": job_family,
+            "job_sub_family": job_sub_family,
+            "time": now,
+        }, ensure_ascii=False) + "\n" for row_id, job_family, job_sub_family in mappings))
+        # Flushed before the rows are journaled, so a resumed run never skips a lost result
+        self._mappings_file.flush()
+        return list(mappings)
+
+    def close(self):
+        for f in (self._records_file, self._mappings_file):
+            if f is not None:
+                f.close()
+        self._records_file = None
+        self._mappings_file = None
+
+class ParquetStore(JsonlStore):
+    """
+    Columnar layout: records are stored in records.parquet with a row_id column and the
+    record as JSON text, so rows with different columns or types share one schema.
+    Mapping results are appended to mappings.jsonl as in the JSONL layout.
+    Requires pyarrow.
+    """
+
+    layout = "parquet"
+
+    def __init__(self, directory, shard_name=None):
+        super().__init__(directory, shard_name)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet storage layout requires pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.records_path = os.path.join(directory, RECORDS_PARQUET)
+        self._writer = None
+        self._buffer = []
+
+    def _iter_raw(self, on_error=print):
+        if not os.path.exists(self.records_path):
+            return
+        parquet_file = self.pq.ParquetFile(self.records_path)
+        for batch in parquet_file.iter_batches(columns=["row_id", "record"]):
+            for row_id, record in zip(batch.column(0).to_pylist(), batch.column(1).to_pylist()):
+                yield {"row_id": row_id, "data": loads(record)}
+
+    def row_ids(self):
+        """Return the identifiers of all records, reading only the row_id column."""
+        if not os.path.exists(self.records_path):
+            return []
+        return self.pq.read_table(self.records_path, columns=["row_id"]).column(0).to_pylist()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        table = self.pa.table({
+            "row_id": [row_id for row_id, _ in self._buffer],
+            "record": [record for _, record in self._buffer],
+        })
+        if self._writer is None:
+            self._writer = self.pq.ParquetWriter(self.records_path, table.schema)
+        self._writer.write_table(table)
+        self._buffer = []
+
+    def write_record(self, row_id, data):
+        """Buffer one extracted record; records are written in row groups."""
+        self._buffer.append((str(row_id), json.dumps(data, ensure_ascii=False)))
+        if len(self._buffer) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        super().close()
+
+def open_store(directory, layout="files", compact=False, shard_name=None):
+    """
+    Open the record store of a directory.
+
+    Args:
+        directory: Directory holding the records
+        layout: "files" (one row_<id>.json per record), "jsonl" or "parquet"
+        compact: Write row files without indentation (files layout)
+        shard_name: Name of the shard whose mapping results this process writes, or None
+
+    Returns:
+        The store instance
+    """
+    if layout == "files":
+        return JsonFileStore(directory, indent=None if compact else 2)
+    if layout == "jsonl":
+        return JsonlStore(directory, shard_name)
+    if layout == "parquet":
+        return ParquetStore(directory, shard_name)
+    raise ValueError(f"Unknown storage layout: {layout}")
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+
+# Maximum number of rows written and journaled together
+WRITE_BATCH_SIZE = 500
+
+# Longest time in seconds a completed row waits in the queue before it is written
+FLUSH_INTERVAL = 1.0
+
+# Queued by close() to stop the writer thread once everything before it is written
+_CLOSE = object()
+
+class ResultWriter:
+    """
+    Writer stage of a mapping run.
+
+    API workers hand completed rows to put(), which only appends them to a queue, so
+    they never wait for the disk. A background thread collects the rows, writes them
+    to the record store in batches and journals them afterwards, so a row is only
+    marked as done once its result is on disk and a killed run simply redoes
+    whatever was still queued.
+    """
+
+    def __init__(self, store, manifest=None, batch_size=WRITE_BATCH_SIZE, flush_interval=FLUSH_INTERVAL, metrics=None):
+        """
+        Start the writer thread.
+
+        Args:
+            store: Record store receiving the mapping results
+            manifest: RunManifest journaling the written rows, or None
+            batch_size: Maximum number of rows written together
+            flush_interval: Longest time in seconds a row waits before it is written
+            metrics: RunMetrics receiving the "write" stage timings, or None
+        """
+        self.store = store
+        self.manifest = manifest
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.written = 0
+        self.error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, row_id, job_family, job_sub_family):
+        """Queue the mapping result of one row; returns immediately."""
+        self._queue.put((row_id, job_family, job_sub_family))
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            # Block until the first row arrives, then at most until the batch is due
+            timeout = max(deadline - time.monotonic(), 0) if batch else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _CLOSE:
+                break
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+            if batch and (item is None or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+        self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            written = self.store.write_mappings(batch)
+            if self.manifest:
+                self.manifest.record_many(written)
+            self.written += len(written)
+        except Exception as e:
+            # Keep draining the queue; close() reports the first failure
+            print(f"Error writing {len(batch)} mapping results: {str(e)}")
+            self.error = self.error or e
+        if self.metrics:
+            self.metrics.add_time("write", time.perf_counter() - start)
+
+    def close(self):
+        """
+        Write every queued row and stop the writer thread.
+
+        Raises:
+            The first exception raised while writing a batch
+        """
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
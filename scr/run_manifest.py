@@ -0,0 +1,80 @@
+import glob
+import json
+import os
+import time
+
+JOURNAL_PREFIX = "mapping_journal"
+
+def load_completed(directory):
+    """
+    Read the latest result of every row from all journals in a directory.
+
+    Returns:
+        Dictionary mapping row identifiers to (job_family, job_sub_family)
+    """
+    completed = {}
+    recorded_at = {}
+    for journal_path in sorted(glob.glob(os.path.join(directory, f"{JOURNAL_PREFIX}_*.jsonl"))):
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a truncated last line; that row is simply redone
+                    continue
+                row = entry["row"]
+                if entry.get("time", 0) >= recorded_at.get(row, 0):
+                    recorded_at[row] = entry.get("time", 0)
+                    completed[row] = (entry.get("job_family"), entry.get("job_sub_family"))
+    return completed
+
+class RunManifest:
+    """
+    Append-only journal of completed rows, used to resume interrupted mapping runs.
+
+    Every process writes its own journal file (one per shard), while the set of
+    completed rows is read from all journals in the directory. This lets several
+    processes or machines share one output directory without writing to the same file.
+    When several journals mention a row, the most recent entry wins.
+    """
+
+    def __init__(self, directory, shard_name="all"):
+        """
+        Load the completed rows from every journal in the directory and open this run's journal.
+
+        Args:
+            directory: Directory holding the journal files, usually the output directory
+            shard_name: Name of the shard written by this process
+        """
+        self.path = os.path.join(directory, f"{JOURNAL_PREFIX}_{shard_name}.jsonl")
+        self.completed = load_completed(directory)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def is_done(self, row_id):
+        """Return True if the row was already mapped to a complete job family and sub-family."""
+        job_family, job_sub_family = self.completed.get(str(row_id), (None, None))
+        return bool(job_family and job_sub_family)
+
+    def record(self, row_id, job_family, job_sub_family):
+        """Append a completed row and its result to the journal."""
+        self.record_many([(row_id, job_family, job_sub_family)])
+
+    def record_many(self, mappings):
+        """Append a batch of completed (row_id, job_family, job_sub_family) rows with a single write."""
+        now = time.time()
+        lines = []
+        for row_id, job_family, job_sub_family in mappings:
+            row = str(row_id)
+            self.completed[row] = (job_family, job_sub_family)
+            lines.append(json.dumps({
+                "row": row,
+                "job_family": job_family,
+                "job_sub_family": job_sub_family,
+                "time": now,
+            }, ensure_ascii=False) + "\n")
+        self._file.write("".join(lines))
+        self._file.flush()
+
+    def close(self):
+        """Close this run's journal."""
+        self._file.close()
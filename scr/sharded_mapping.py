@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+
+import map_job_families as mapper
+from instrumentation import RunMetrics
+from record_store import STORAGE_LAYOUTS, open_store
+from run_manifest import load_completed
+
+# Merged timings and counters of all shards run by this driver
+metrics = RunMetrics("mapping")
+
+def load_deployments(path=None):
+    """
+    Load the deployments the shards are spread over.
+
+    The file holds a JSON list of objects with any of "endpoint", "deployment",
+    "api_key_env" (name of the environment variable holding the key), "api_version",
+    "rpm", "tpm" and "concurrency"; missing settings fall back to the environment.
+
+    Returns:
+        List of deployment dictionaries; a single entry using the environment without a file
+    """
+    if path is None:
+        return [{}]
+    with open(path, "r", encoding="utf-8") as f:
+        deployments = json.load(f)
+    if not isinstance(deployments, list) or not deployments:
+        raise ValueError(f"{path} must contain a non-empty JSON list of deployments")
+    return deployments
+
+def plan_shards(deployments, shards):
+    """
+    Assign every shard a deployment and its share of that deployment's quotas.
+
+    Shards are dealt round-robin over the deployments; shards sharing a deployment split
+    its requests-per-minute, tokens-per-minute and concurrency evenly, so together they
+    stay within its limits.
+
+    Returns:
+        List with the deployment settings of every shard, indexed by shard
+    """
+    plans = []
+    for index in range(shards):
+        deployment = deployments[index % len(deployments)]
+        sharing = len(range(index % len(deployments), shards, len(deployments)))
+        plan = dict(deployment)
+        for quota in ("rpm", "tpm", "concurrency"):
+            if deployment.get(quota):
+                plan[quota] = max(1, deployment[quota] // sharing)
+        plans.append(plan)
+    return plans
+
+def run_shard(index, shards, deployment, options):
+    """
+    Map one shard in a worker process, logging to shard_<index>of<shards>.log in the output directory.
+
+    Returns:
+        Tuple of (index, report, latencies) with the shard's run report and request latencies
+    """
+    output_dir = options["output_dir"]
+    log_path = os.path.join(output_dir, f"shard_{index}of{shards}.log")
+    with open(log_path, "a", encoding="utf-8", buffering=1) as log, redirect_stdout(log):
+        api_key = os.getenv(deployment["api_key_env"]) if deployment.get("api_key_env") else None
+        mapper.configure(deployment.get("endpoint"), deployment.get("deployment"), api_key, deployment.get("api_version"))
+        mapper.process_files(
+            shard=(index, shards),
+            async_mode=True,
+            concurrency=deployment.get("concurrency", 8),
+            requests_per_minute=deployment.get("rpm"),
+            tokens_per_minute=deployment.get("tpm"),
+            **options,
+        )
+        mapper.metrics.write_report(os.path.join(output_dir, f"run_report_mapping_shard{index}of{shards}.json"))
+    return index, mapper.metrics.report(), list(mapper.metrics.latencies)
+
+def run_sharded(deployments, shards=None, only=None, workers=None, **options):
+    """
+    Map the output directory in hash shards, one worker process per shard.
+
+    Args:
+        deployments: List of deployment dictionaries, see load_deployments
+        shards: Total number of shards, across all hosts; defaults to one per deployment
+        only: Indices of the shards to run on this host, or None for all of them
+        workers: Maximum number of shards mapped at the same time; defaults to one per shard
+        **options: Further process_files options, e.g. output_dir, storage or resume
+
+    Returns:
+        Dictionary mapping each shard index to its run report
+    """
+    shards = shards or len(deployments)
+    plans = plan_shards(deployments, shards)
+    indices = sorted(set(only)) if only is not None else list(range(shards))
+    if any(index < 0 or index >= shards for index in indices):
+        raise ValueError(f"Shard indices must be between 0 and {shards - 1}")
+    metrics.reset()
+
+    print(f"Mapping {len(indices)} of {shards} shards over {len(deployments)} deployments")
+    for index in indices:
+        plan = plans[index]
+        print(f"  shard {index}: {plan.get('endpoint') or mapper.endpoint} / {plan.get('deployment') or mapper.deployment}"
+              f" (rpm {plan.get('rpm') or 'unlimited'}, tpm {plan.get('tpm') or 'unlimited'}, concurrency {plan.get('concurrency', 8)})")
+
+    reports = {}
+    with ProcessPoolExecutor(max_workers=workers or len(indices)) as pool:
+        futures = {pool.submit(run_shard, index, shards, plans[index], options): index for index in indices}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                _, report, latencies = future.result()
+            except Exception as e:
+                print(f"Error: shard {index} failed: {str(e)}")
+                continue
+            reports[index] = report
+            metrics.merge(report, latencies)
+            counters = report["counters"]
+            print(f"Shard {index} finished in {report['wall_seconds']:.1f}s: {counters.get('rows', 0)} rows, "
+                  f"{counters.get('requests', 0)} requests, {counters.get('rows_unmapped', 0)} unmapped")
+    return reports
+
+def print_progress(output_dir, storage):
+    """Print how many rows of the whole directory are mapped according to the journals of every shard and host."""
+    total = len(open_store(output_dir, storage).row_ids())
+    completed = load_completed(output_dir)
+    mapped = sum(1 for job_family, job_sub_family in completed.values() if job_family and job_sub_family)
+    print(f"Progress: {mapped} of {total} rows mapped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map job families with one worker process per hash shard of the rows.")
+    parser.add_argument("--config", type=str, default=None, help="JSON list of deployments (endpoint, deployment, api_key_env, rpm, tpm, concurrency).")
+    parser.add_argument("--shards", type=int, default=None, help="Total number of shards across all hosts (default: one per deployment).")
+    parser.add_argument("--only", type=str, default=None, help="Comma-separated shard indices to run on this host (default: all).")
+    parser.add_argument("--workers", type=int, default=None, help="Maximum number of shards mapped at the same time (default: one per shard).")
+    parser.add_argument("--output", type=str, default="output", help="Directory holding the extracted records.")
+    parser.add_argument("--storage", choices=STORAGE_LAYOUTS, default="files", help="Record layout: one row_x.json per record, a single JSONL file, or Parquet.")
+    parser.add_argument("--resume", action="store_true", help="Skip rows already completed according to the run journals.")
+    parser.add_argument("--changed_only", action="store_true", help="Only map rows that the last incremental extraction added or modified.")
+    parser.add_argument("--positions_per_call", type=int, default=1, help="Number of distinct positions classified in one API call.")
+    parser.add_argument("--no_local", action="store_true", help="Send every position to the API instead of answering close matches locally.")
+    parser.add_argument("--no_cache", action="store_true", help="Disable the persistent mapping cache.")
+    parser.add_argument("--cache_path", type=str, default=mapper.DEFAULT_CACHE_PATH, help="Path of the SQLite mapping cache shared by the shards.")
+    parser.add_argument("--compact_json", action="store_true", help="Write row files without indentation.")
+    parser.add_argument("--report", type=str, default=None, help="Path of the merged JSON run report (default: <output>/run_report_mapping.json).")
+    parser.add_argument("--prometheus", type=str, default=None, help="Also write the merged metrics in Prometheus text format to this path.")
+    args = parser.parse_args()
+
+    deployments = load_deployments(args.config)
+    only = [int(index) for index in args.only.split(",")] if args.only else None
+    start = time.perf_counter()
+    run_sharded(
+        deployments,
+        shards=args.shards,
+        only=only,
+        workers=args.workers,
+        output_dir=args.output,
+        storage=args.storage,
+        resume=args.resume,
+        changed_only=args.changed_only,
+        positions_per_call=args.positions_per_call,
+        use_local_classifier=not args.no_local,
+        use_cache=not args.no_cache,
+        cache_path=args.cache_path,
+        compact_json=args.compact_json,
+    )
+    print(f"All shards finished in {time.perf_counter() - start:.1f}s")
+    print_progress(args.output, args.storage)
+    metrics.write_report(args.report or os.path.join(args.output, "run_report_mapping.json"), args.prometheus)
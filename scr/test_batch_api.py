@@ -0,0 +1,92 @@
+import glob
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+
+import map_job_families as mapper
+from mock_azure_server import load_categories, start_mock_server
+from record_store import open_store
+from run_manifest import JOURNAL_PREFIX, load_completed
+
+# Rows and distinct positions of the synthetic output directory
+ROWS = 120
+DISTINCT_POSITIONS = 70
+
+# Fraction of batch request lines the stand-in server fails
+BATCH_FAILURE_RATE = 0.3
+
+def write_rows(output_dir):
+    """Write fresh, unmapped row files and forget any journaled results."""
+    store = open_store(output_dir, "files")
+    store.reset()
+    for path in glob.glob(os.path.join(output_dir, f"{JOURNAL_PREFIX}_*.jsonl")):
+        os.remove(path)
+    for i in range(1, ROWS + 1):
+        store.write_record(i, {"No": i, "Position": f"Sales Executive {i % DISTINCT_POSITIONS}", "Industry": "Retail"})
+    store.close()
+
+def run_batch(output_dir, **options):
+    """Map output_dir with the Batch API; returns the printed log."""
+    log = StringIO()
+    with redirect_stdout(log):
+        mapper.process_files(batch_api=True, poll_interval=0.01, use_cache=False, use_local_classifier=False,
+                             positions_per_call=5, output_dir=output_dir, **options)
+    return log.getvalue()
+
+def assert_all_rows_written(output_dir, log):
+    """Every row must end with a written result, mapped or explicitly unmapped, and be journaled."""
+    records = dict(open_store(output_dir, "files").iter_records())
+    missing = [row_id for row_id, data in records.items() if "job_family" not in data]
+    assert len(records) == ROWS, f"expected {ROWS} rows, found {len(records)}"
+    assert not missing, f"{len(missing)} rows were never written, e.g. {missing[:5]}\n{log}"
+    journaled = load_completed(output_dir)
+    assert set(records) <= set(journaled), f"{len(set(records) - set(journaled))} rows were not journaled\n{log}"
+    return sum(1 for data in records.values() if data["job_family"] and data["job_sub_family"])
+
+def with_mock_server(test):
+    """Run test(output_dir, server) against a stand-in server failing some batch lines, in a scratch directory."""
+    server = start_mock_server(load_categories(), batch_failure_rate=BATCH_FAILURE_RATE, seed=7)
+    output_dir = tempfile.mkdtemp(prefix="batch-api-test-")
+    mapper.configure(endpoint=f"http://127.0.0.1:{server.server_address[1]}/", deployment="mock",
+                     api_key="mock", api_version="2025-03-01-preview")
+    try:
+        test(output_dir, server)
+    finally:
+        mapper.configure()
+        server.shutdown()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def test_batch_api_fresh_run():
+    """Failed batch lines are retried one position per request; leftovers are written as unmapped."""
+    def test(output_dir, server):
+        write_rows(output_dir)
+        log = run_batch(output_dir, batch_retries=2)
+        mapped = assert_all_rows_written(output_dir, log)
+        assert "Resubmitting" in log, log
+        assert mapped > 0, log
+    with_mock_server(test)
+
+def test_batch_api_resume():
+    """Resuming any saved batch, including a retry batch, still leaves no row unwritten."""
+    def test(output_dir, server):
+        write_rows(output_dir)
+        run_batch(output_dir, batch_retries=1)
+        batch_ids = [os.path.basename(path)[len("batch_"):-len(".json")]
+                     for path in glob.glob(os.path.join(output_dir, "batch_*.json"))]
+        assert len(batch_ids) >= 2, "expected the first batch and at least one retry batch"
+
+        server.state.batch_failure_rate = 0.0
+        for batch_id in batch_ids:
+            write_rows(output_dir)
+            log = run_batch(output_dir, batch_id=batch_id, batch_retries=0)
+            assert f"Resuming batch {batch_id}" in log, log
+            mapped = assert_all_rows_written(output_dir, log)
+            assert mapped == ROWS, f"only {mapped} of {ROWS} rows mapped after resuming {batch_id}\n{log}"
+    with_mock_server(test)
+
+if __name__ == "__main__":
+    for test in (test_batch_api_fresh_run, test_batch_api_resume):
+        test()
+        print(f"{test.__name__}: ok")
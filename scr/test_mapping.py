@@ -2,6 +2,8 @@ import json
 import os
 from openai import OpenAI
 
+from lexical_classifier import LexicalClassifier
+
 def test_mapping():
     """Test the mapping functionality on a single JSON file"""
     
@@ -30,22 +32,20 @@ def test_mapping():
         # For testing, we'll just print what the mapping would be based on job-category.json
         # without making an actual API call
         
-        possible_matches = []
-        
-        # Simple keyword matching example (in a real scenario, this would use the OpenAI API)
-        position_lower = position.lower()
-        
-        for family, sub_families in job_categories.items():
-            for sub_family in sub_families:
-                if any(keyword in position_lower for keyword in [word.lower() for word in sub_family.split()]):
-                    possible_matches.append((family, sub_family))
+        # Score the position against every sub-family with the local lexical classifier
+        classifier = LexicalClassifier(job_categories)
+        possible_matches = classifier.top_matches(position, k=5)
         
         if possible_matches:
-            print("\nPossible matches based on simple keyword matching:")
-            for family, sub_family in possible_matches:
-                print(f"  {family} / {sub_family}")
+            print("\nClosest sub-families from the local lexical classifier:")
+            for sub_family, families, score in possible_matches:
+                print(f"  {' | '.join(families)} / {sub_family} (similarity {score:.2f})")
         else:
-            print("\nNo matches found with simple keyword matching")
+            print("\nNo matches found by the local lexical classifier")
+        
+        local_match = classifier.classify(position)
+        if local_match:
+            print(f"Confident local answer, no API call needed: {local_match[0]} / {local_match[1]}")
             
         print("\nIn the actual script, OpenAI's GPT-4.1-mini would be used for more accurate mapping")
         